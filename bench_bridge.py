@@ -0,0 +1,249 @@
+"""End-to-end benchmark: runs inverter_bridge.py against inverter_sim.py on loopback.
+
+The bridge runs in its own process on free ports, with its energy file, journal, sample log
+and dongle profiles in a temporary directory, so nothing on the host is touched and no network is needed.
+Reports poll-cycle latency, samples per second, command and HTTP round-trip time and reconnect time.
+
+    python3 bench_bridge.py                        # defaults: 1 s polling, 10 s run
+    python3 bench_bridge.py --interval 0.05 --latency 5 --json bench.json
+"""
+import argparse
+import bisect
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import inverter_sim
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+BRIDGE_BOOT = """
+import sys
+sys.path.insert(0, {here!r})
+import inverter_bridge as bridge
+bridge.ENERGY_FILE = {energy!r}
+bridge.ENERGY_JOURNAL = {journal!r}
+bridge.LOG_DIR = {log_dir!r}
+bridge.PROFILE_DIR = {profile_dir!r}
+bridge.BIND_IP = "127.0.0.1"
+bridge.INVERTER_PORT = {inverter_port}
+bridge.LOCAL_CONTROL_PORT = {control_port}
+bridge.METRICS_PORT = None
+bridge.API_PORT = {api_port}
+bridge.POLL_INTERVAL = {interval}
+bridge.POLL_GROUPS = dict(bridge.POLL_GROUPS, realtime=({interval}, 0))
+bridge.main()
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentiles(values, points=(50, 95, 99)):
+    """Nearest-rank percentiles in milliseconds, plus max and count."""
+    if not values: return {"n": 0}
+    ordered = sorted(values)
+    out = {f"p{p}": round(ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))] * 1000, 2)
+           for p in points}
+    out["max"] = round(ordered[-1] * 1000, 2)
+    out["n"] = len(ordered)
+    return out
+
+class Recorder:
+    """Collects the simulator's events; list.append is atomic, so no lock is needed."""
+    def __init__(self):
+        self.connects, self.rt_requests, self.rt_responses = [], [], []
+
+    def __call__(self, kind, t, detail):
+        if kind == "connect": self.connects.append(t)
+        elif detail and detail[0] == 3 and detail[1] == 200:
+            (self.rt_requests if kind == "request" else self.rt_responses).append(t)
+
+def wait_for_port(port, timeout=15.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"bridge did not open port {port}")
+
+def subscribe(port, arrivals, stop):
+    """Records the arrival time of every pushed update after the initial full snapshot."""
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(b"SUBSCRIBE\n")
+        s.settimeout(0.5)
+        buf, first = b"", True
+        while not stop.is_set():
+            try: data = s.recv(65536)
+            except socket.timeout: continue
+            if not data: break
+            now = time.time()
+            buf += data
+            *lines, buf = buf.split(b"\n")
+            for _ in lines:
+                if first: first = False  # The full snapshot sent on subscribe
+                else: arrivals.append(now)
+
+def command_rtts(port, commands):
+    """Round trip of each command on one SESSION connection, sent one at a time."""
+    rtts = []
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        f = s.makefile("rb")
+        s.sendall(b"SESSION\n")
+        f.readline()
+        for cmd in commands:
+            started = time.perf_counter()
+            s.sendall(cmd.encode() + b"\n")
+            reply = f.readline()
+            rtts.append(time.perf_counter() - started)
+            if reply.startswith(b"ERR"): print(f"[!] {cmd}: {reply.decode().strip()}")
+        s.sendall(b"QUIT\n")
+    return rtts
+
+def http_rtts(port, path, count, revalidate=False):
+    """Round trip of GET `path` on one keep-alive connection; with `revalidate`, every
+    request after the first sends If-None-Match with the last ETag."""
+    rtts, etag = [], None
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for _ in range(count):
+        headers = {"If-None-Match": etag} if revalidate and etag else {}
+        started = time.perf_counter()
+        conn.request("GET", path, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        rtts.append(time.perf_counter() - started)
+        etag = response.getheader("ETag")
+    conn.close()
+    return rtts
+
+def run(args):
+    recorder = Recorder()
+    inverter_port, control_port, api_port = free_port(), free_port(), free_port()
+    with tempfile.TemporaryDirectory(prefix="bridge-bench-") as tmp:
+        boot = BRIDGE_BOOT.format(here=HERE, energy=os.path.join(tmp, "energy.json"),
+                                  journal=os.path.join(tmp, "energy.wal"), log_dir=os.path.join(tmp, "log"),
+                                  profile_dir=os.path.join(tmp, "profiles"),
+                                  inverter_port=inverter_port, control_port=control_port, api_port=api_port,
+                                  interval=args.interval)
+        log = open(os.path.join(tmp, "bridge.log"), "w")
+        bridge = subprocess.Popen([sys.executable, "-u", "-c", boot], stdout=log, stderr=subprocess.STDOUT)
+        try:
+            wait_for_port(control_port)
+            sim = inverter_sim.SimulatedInverter("E5000BENCH", seed=args.seed)
+            dongle = inverter_sim.Dongle(sim, "127.0.0.1", inverter_port, latency=args.latency / 1000,
+                                         jitter=args.jitter / 1000, reconnect_delay=0.0,
+                                         on_event=recorder).start()
+            deadline = time.time() + 15
+            while not recorder.rt_responses and time.time() < deadline: time.sleep(0.05)
+            if not recorder.rt_responses: raise RuntimeError("bridge never polled the simulator")
+            time.sleep(args.warmup)
+            results = {"config": {"interval_s": args.interval, "latency_ms": args.latency,
+                                  "jitter_ms": args.jitter, "duration_s": args.duration}}
+
+            # --- POLLING ---
+            print(f"[*] Polling for {args.duration:g} s...")
+            arrivals, stop = [], threading.Event()
+            sub = threading.Thread(target=subscribe, args=(control_port, arrivals, stop), daemon=True)
+            sub.start()
+            begin, first = time.time(), len(recorder.rt_requests)
+            time.sleep(args.duration)
+            stop.set()
+            sub.join(2)
+            requests = [t for t in recorder.rt_requests[first:] if t >= begin]
+            responses = [t for t in recorder.rt_responses if t >= begin]
+            latencies = []
+            for t in arrivals:
+                i = bisect.bisect_right(requests, t) - 1  # The read that produced this update
+                if i >= 0: latencies.append(t - requests[i])
+            results["poll"] = {
+                "samples_per_s": round(len(responses) / args.duration, 2),
+                "updates_per_s": round(len(arrivals) / args.duration, 2),
+                "cycle_latency_ms": percentiles(latencies),
+                "period_ms": percentiles([b - a for a, b in zip(requests, requests[1:])]),
+            }
+
+            # --- COMMANDS ---
+            print(f"[*] {args.commands} reads and {args.writes} writes...")
+            results["commands"] = {
+                "json_rtt_ms": percentiles(command_rtts(control_port, ["JSON"] * args.commands)),
+                "history_rtt_ms": percentiles(command_rtts(control_port, ["HISTORY batt_volt 3600 60"] * 20)),
+                "write_rtt_ms": percentiles(command_rtts(
+                    control_port, [f"SET_SOC_CUTOFF_{3 + i % 2}" for i in range(args.writes)])),
+                "http_rtt_ms": percentiles(http_rtts(api_port, "/api/snapshot", args.commands)),
+                "http_304_rtt_ms": percentiles(http_rtts(api_port, "/api/snapshot", args.commands, revalidate=True)),
+            }
+
+            # --- RECONNECTS ---
+            print(f"[*] {args.reconnects} forced reconnects...")
+            recovery = []
+            for _ in range(args.reconnects):
+                seen = len(recorder.rt_responses)
+                dropped = time.time()
+                dongle.disconnect()
+                deadline = dropped + 30
+                while time.time() < deadline:
+                    fresh = [t for t in recorder.rt_responses[seen:] if t > dropped]
+                    if fresh and recorder.connects[-1] > dropped:
+                        recovery.append(fresh[0] - dropped)
+                        break
+                    time.sleep(0.01)
+                time.sleep(max(1.0, args.interval * 3))
+            results["reconnect_ms"] = percentiles(recovery)
+            dongle.stop()
+        finally:
+            bridge.send_signal(signal.SIGTERM)
+            try: bridge.wait(5)
+            except subprocess.TimeoutExpired: bridge.kill()
+            log.close()
+            if args.bridge_log:
+                with open(os.path.join(tmp, "bridge.log")) as f: sys.stdout.write(f.read())
+    return results
+
+def report(results):
+    rows = [("poll cycle (read -> push)", results["poll"]["cycle_latency_ms"]),
+            ("realtime period", results["poll"]["period_ms"]),
+            ("JSON round trip", results["commands"]["json_rtt_ms"]),
+            ("HISTORY round trip", results["commands"]["history_rtt_ms"]),
+            ("verified write round trip", results["commands"]["write_rtt_ms"]),
+            ("HTTP snapshot round trip", results["commands"]["http_rtt_ms"]),
+            ("HTTP revalidate (304)", results["commands"]["http_304_rtt_ms"]),
+            ("reconnect to first sample", results["reconnect_ms"])]
+    print()
+    print(f"{'metric (ms)':<28}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}{'n':>7}")
+    for name, p in rows:
+        print(f"{name:<28}" + "".join(f"{p.get(k, '-'):>10}" for k in ("p50", "p95", "p99", "max")) + f"{p['n']:>7}")
+    print(f"\nsamples/s: {results['poll']['samples_per_s']}   pushed updates/s: {results['poll']['updates_per_s']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark inverter_bridge.py against the simulator")
+    parser.add_argument("--interval", type=float, default=1.0, help="realtime poll interval under test (s)")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of polling to measure")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds to wait after the first sample")
+    parser.add_argument("--latency", type=float, default=20.0, help="simulated dongle reply delay (ms)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random reply delay up to (ms)")
+    parser.add_argument("--commands", type=int, default=200, help="JSON round trips to time")
+    parser.add_argument("--writes", type=int, default=10, help="verified writes to time")
+    parser.add_argument("--reconnects", type=int, default=3, help="forced disconnects to time")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--bridge-log", action="store_true", help="print the bridge's output afterwards")
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as f: json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
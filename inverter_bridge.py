@@ -1,12 +1,28 @@
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import gzip
+import math
+import mmap
 import socket
 import threading
 import struct
 import time
 import json
+import urllib.parse
+import zlib
 import os
 import signal
 import sys
 
+try:
+    import numpy as np  # Optional: vectorizes HISTORY queries; the array module is the fallback
+except ImportError:
+    np = None
+
 # --- CONFIGURATION ---
 INVERTER_PORT = 18899
 LOCAL_CONTROL_PORT = 9999
@@ -14,21 +30,100 @@ BIND_IP = '0.0.0.0'
 POLL_INTERVAL = 1.0 
 INVERTER_RATED_WATT = 6200 
 OFFLINE_THRESHOLD = 10 
+MODBUS_TIMEOUT = 2.5  # Per-request deadline for a complete response frame
+MAX_PENDING_DONGLES = 16  # listen() backlog; each dongle gets its own session thread
+
+# --- RECONNECT ---
+KEEPALIVE_IDLE = 5        # Seconds of silence before the kernel probes a dongle socket...
+KEEPALIVE_INTERVAL = 2    # ...then probes this often...
+KEEPALIVE_COUNT = 3       # ...and resets the socket after this many go unanswered
+STALE_LINK_SECONDS = 6.0  # Requests unanswered (not even garbage) for this long end the session
+STALE_AFTER_FAILURES = 1  # Failed realtime reads in a row before the values are marked stale
+SETTLE_DELAY = 0.5        # Pause after the handshake, skipped once a dongle has done without it
 
 # --- ENERGY MIGRATION ---
 ENERGY_FILE = "/root/inverter_energy.json"
-SAVE_INTERVAL = 300  # Save to NAND every 5 minutes
+ENERGY_JOURNAL = "/root/inverter_energy.wal"  # Increments since the last save, replayed at startup
+JOURNAL_SYNC_INTERVAL = 15.0  # fsync new increments this often: at most this much kWh is lost on a power cut
+SAVE_INTERVAL = 3600  # Compact the journal into ENERGY_FILE every hour
+ENERGY_MAX_GAP = 30.0  # Longest gap between two samples bridged by linear interpolation (s)
 
-# --- TRANSLATION MAPS (Updated from v89) ---
-STATUS_MAP = {
-    0: "Power On", 1: "Standby", 2: "Line Mode (On-Grid)",
-    3: "Off-Grid (Battery)", 4: "Bypass", 5: "Charging", 6: "Fault"
-}
+# --- DERIVED METRICS ---
+DERIVED_WINDOW = 300  # Rolling averages over this many seconds
+ROLLING_FIELDS = ("ac_load_real_watt", "pv_input_watt", "grid_power_watt", "batt_power_watt")
+PEAK_FIELDS = ("ac_load_real_watt", "pv_input_watt", "grid_power_watt")  # Daily and monthly maxima
 
-BATTERY_TYPE_MAP = {
-    0: "AGN", 1: "FLD", 2: "USR", 4: "LI2", 
-    6: "LI4", 8: "LIb"
+# --- REGISTER MAP ---
+# Register layout, scaling and enums live in a data file so other models (e.g. Voltronic/Axpert)
+# only need their own map instead of a fork of this script.
+REGISTER_MAP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "registers_srne.json")
+
+# --- POLL SCHEDULER ---
+POLL_GROUPS = {  # Register group: (target interval in seconds, priority; 0 = most important)
+    "realtime": (POLL_INTERVAL, 0),
+    "faults": (2.0, 1),
+    "settings": (5.0, 2),
 }
+MAX_READ_REGISTERS = 40  # Largest single read the dongle is known to accept (200-239)
+MAX_COALESCE_GAP = 20    # Merge declared blocks separated by at most this many unused registers
+MAX_BACKOFF = 8.0        # Interval multiplier ceiling while the dongle keeps timing out
+
+# --- BURST SAMPLING ---
+BURST_FIELDS = (  # Read during BURST; keeps every ENERGY_CHANNELS input so energy still integrates
+    "grid_power_watt", "ac_load_real_watt", "batt_volt", "batt_current", "pv_input_watt",
+)
+BURST_MAX_SECONDS = 600      # Longest burst one command may request
+BURST_MAX_SAMPLES = 100000   # Buffer cap (28 bytes per sample); the burst ends early when full
+
+# --- REGISTER DISCOVERY (--scan) ---
+PROFILE_DIR = "/root/inverter_profiles"  # <serial>.json per scanned dongle, loaded at connect
+SCAN_RANGE = (0, 1000)   # Holding registers swept by --scan unless a range is given
+SCAN_MAX_COUNT = 125     # Protocol limit for one function 3 read
+SCAN_RESOLUTION = 10     # Rejected pieces this short are skipped whole unless they border an answered run
+SCAN_PIPELINE = 4        # Reads in flight at once; drops to 1 if the dongle loses a reply
+SCAN_TIMEOUT = 1.0       # Per-read deadline while scanning
+SCAN_RETRIES = 2         # Repeats of an unanswered read before it counts as rejected
+
+# --- WRITE QUEUE ---
+MAX_WRITE_REGISTERS = 10  # Largest multi-register (function 16) write frame
+MAX_WRITE_GAP = 4         # Mapped, writable registers between two queued writes that may be
+                          # re-written with the value read just before the frame
+WRITE_TIMEOUT = 10.0      # How long a control client waits for its write to be verified
+READBACK_ATTEMPTS = 2     # Read-backs before a write is reported as not applied
+
+# --- HISTORY (in-memory ring buffers) ---
+HISTORY_SECONDS = 24 * 3600  # Full-resolution span kept per inverter (at POLL_INTERVAL)
+HISTORY_MAX_POINTS = 2000    # HISTORY widens the step so a reply never exceeds this many buckets
+HISTORY_FIELDS = (           # Realtime sensors recorded each sample, 4 bytes each
+    "grid_volt", "grid_freq", "grid_power_watt", "grid_current", "ac_out_volt", "ac_out_amp",
+    "ac_load_real_watt", "ac_load_va", "ac_load_pct", "batt_volt", "batt_current", "batt_power_watt",
+    "batt_soc", "pv_input_volt", "pv_input_watt", "pv_current", "pv_charging_watt", "temp_inv", "temp_dc",
+)
+
+# --- SAMPLE LOG (on-disk, append-only) ---
+LOG_DIR = "/root/inverter_log"  # One subdirectory per inverter serial
+LOG_FLUSH_INTERVAL = 60.0       # Samples are batched into one append per file this often (s)
+LOG_RETENTION = {"raw": 7 * 86400, "1m": 90 * 86400, "1h": None}  # Seconds per tier; None = forever
+
+# --- FAULT EVENTS ---
+EVENT_JOURNAL_SIZE = 1000  # Raise/clear events kept per inverter, in memory and in <LOG_DIR>/<serial>/events.jsonl
+EVENT_CONTEXT_FIELDS = (   # Realtime values recorded with each event
+    "batt_volt", "batt_current", "batt_soc", "ac_load_real_watt", "grid_volt", "pv_input_watt",
+    "temp_inv", "temp_dc", "device_status_msg",
+)
+
+# --- FRAME CAPTURE ---
+CAPTURE_DIR = None  # e.g. "/root/inverter_capture" records every Modbus frame for --replay
+CAPTURE_MAX_BYTES = 8 * 1024 * 1024  # Size of one capture file before it is rotated
+CAPTURE_KEEP = 4                     # Rotated files kept per inverter (<serial>.cap.1 is the newest)
+
+# --- METRICS ---
+METRICS_PORT = 9108  # Prometheus text format at http://<bridge>:9108/metrics; None disables it
+
+# --- HTTP API ---
+API_PORT = 8099          # JSON snapshots at http://<bridge>:8099/api/...; None disables it
+GZIP_MIN_BYTES = 512     # Smaller responses are sent uncompressed
+HTTP_IDLE_TIMEOUT = 60.0 # Keep-alive connections idle this long are closed
 
 # --- FAULT CODES (New from v89) ---
 FAULT_BIT_MAP = {
@@ -49,75 +144,369 @@ WARNING_BIT_MAP = {
 }
 
 # --- SHARED STATE ---
-current_inverter_conn = None
-modbus_lock = threading.Lock()
-last_cmd_time = 0 
+inverters = {}  # Dongle serial (from AT+DTUPN?) -> Inverter
+inverters_lock = threading.Lock()
 energy_lock = threading.Lock()
+journal_lock = threading.Lock()  # Energy file and journal I/O; taken before energy_lock is released
 
 # --- HELPER: DECODE BITMASKS (From v89) ---
-def decode_flags(val, map_dict, prefix="Unknown"):
-    active_list = []
-    if val == 0: return []
-    for bit in range(32):
-        if (val >> bit) & 1:
-            msg = map_dict.get(bit, f"{prefix} (Bit {bit})")
-            active_list.append(msg)
-    return active_list
+class FlagTable:
+    """Bit -> message for one 32-bit flags register, precomputed per byte: a decode is four
+    table lookups instead of a walk over 32 bits. Results are memoized per code, since an
+    inverter only ever shows a handful of distinct codes."""
+    def __init__(self, map_dict, prefix, none_msg):
+        self.names = [map_dict.get(bit, f"{prefix} (Bit {bit})") for bit in range(32)]
+        self.none_msg = none_msg
+        self.bytes = [[tuple(self.names[shift + bit] for bit in range(8) if (val >> bit) & 1) for val in range(256)]
+                      for shift in (0, 8, 16, 24)]
+        self.memo = {0: ([], none_msg)}
+
+    def decode(self, val):
+        """(active messages in bit order, summary text). The list is shared: do not modify it."""
+        hit = self.memo.get(val)
+        if hit is None:
+            b0, b1, b2, b3 = self.bytes
+            active = list(b0[val & 0xFF] + b1[(val >> 8) & 0xFF] + b2[(val >> 16) & 0xFF] + b3[(val >> 24) & 0xFF])
+            if len(self.memo) > 256: self.memo = {0: self.memo[0]}
+            hit = self.memo[val] = (active, ", ".join(active))
+        return hit
+
+def set_bits(val):
+    """Numbers of the set bits in `val`, lowest first."""
+    out = []
+    while val:
+        low = val & -val
+        out.append(low.bit_length() - 1)
+        val ^= low
+    return out
 
 # --- SMART LOAD WITH ALL ENERGY OFFSETS ---
+ENERGY_DEFAULTS = {
+    "total_pv_kwh": 0.0,
+    "total_grid_input_kwh": 0.0,
+    "total_load_kwh": 0.0,
+    "total_battery_charge_kwh": 0.0,
+    "total_battery_discharge_kwh": 0.0
+}
+LEGACY_ENERGY_KEY = "_legacy"  # Pre multi-inverter totals, adopted by the first new serial
+JOURNAL_SEQ_KEY = "_journal_seq"  # Last journal record already folded into ENERGY_FILE
+JOURNAL_HEADER = struct.Struct('<QH')  # seq, serial length; then the serial, JOURNAL_DELTAS and a CRC32
+JOURNAL_DELTAS = struct.Struct('<5d')  # kWh increments in ENERGY_DEFAULTS order
+
+def energy_entry(data, serial):
+    """Totals of one serial in `data`; the first new serial adopts single-inverter totals."""
+    if serial not in data:
+        legacy = data.pop(LEGACY_ENERGY_KEY, None)
+        if legacy is not None:
+            print(f"[*] Migrating single-inverter energy totals to {serial}")
+        data[serial] = legacy if legacy is not None else ENERGY_DEFAULTS.copy()
+    return data[serial]
+
+def replay_energy_journal(data, seq):
+    """Adds journal records newer than `seq` to the loaded totals. Stops at the first torn
+    or corrupt record, which can only be the tail written during a power cut, and cuts the
+    file back to the last good record so new appends stay aligned."""
+    try:
+        with open(ENERGY_JOURNAL, 'rb') as f: raw = f.read()
+    except FileNotFoundError:
+        return seq
+    replayed, good = 0, 0
+    while good + JOURNAL_HEADER.size <= len(raw):
+        rec_seq, length = JOURNAL_HEADER.unpack_from(raw, good)
+        end = good + JOURNAL_HEADER.size + length + JOURNAL_DELTAS.size
+        if end + 4 > len(raw) or struct.unpack_from('<I', raw, end)[0] != zlib.crc32(raw[good:end]): break
+        serial = raw[good + JOURNAL_HEADER.size:end - JOURNAL_DELTAS.size]
+        deltas = JOURNAL_DELTAS.unpack_from(raw, end - JOURNAL_DELTAS.size)
+        good = end + 4
+        if rec_seq <= seq: continue
+        totals = energy_entry(data, serial.decode())
+        for key, delta in zip(ENERGY_DEFAULTS, deltas):
+            totals[key] = totals.get(key, 0.0) + delta
+        seq, replayed = rec_seq, replayed + 1
+    if replayed: print(f"[*] Replayed {replayed} energy journal records")
+    if good < len(raw):
+        print(f"[!] Energy journal: dropping {len(raw) - good} bytes of torn tail")
+        try: os.truncate(ENERGY_JOURNAL, good)
+        except OSError as e: print(f"[!] Energy journal truncate failed: {e}")
+    return seq
+
 def load_or_create_energy_data():
-    """Load energy data from disk or create new structure with offsets."""
-    default_structure = {
-        "total_pv_kwh": 0.0,
-        "total_grid_input_kwh": 0.0,
-        "total_load_kwh": 0.0,
-        "total_battery_charge_kwh": 0.0,
-        "total_battery_discharge_kwh": 0.0
-    }
-    
+    """Load per-inverter energy data from disk (keyed by dongle serial), plus the journal."""
+    global journal_seq
+    data = {}
     if os.path.exists(ENERGY_FILE):
         try:
             with open(ENERGY_FILE, 'r') as f:
                 data = json.load(f)
-                # Ensure all keys exist (migration-safe)
-                for key in default_structure:
-                    if key not in data:
-                        data[key] = default_structure[key]
-                print(f"[*] Loaded energy data:")
-                print(f"    PV: {data['total_pv_kwh']:.2f} kWh")
-                print(f"    Grid Input: {data['total_grid_input_kwh']:.2f} kWh")
-                print(f"    Load: {data['total_load_kwh']:.2f} kWh")
-                print(f"    Battery Charge: {data['total_battery_charge_kwh']:.2f} kWh")
-                print(f"    Battery Discharge: {data['total_battery_discharge_kwh']:.2f} kWh")
-                return data
+            # Single-inverter files kept the totals at the top level
+            if "total_pv_kwh" in data:
+                data = {LEGACY_ENERGY_KEY: data}
         except Exception as e:
             print(f"[!] Error loading energy file: {e}")
             print("[*] Creating new energy data structure.")
-            return default_structure.copy()
+            data = {}
     else:
         print(f"[*] No energy file found. Creating new structure.")
-        return default_structure.copy()
+    journal_seq = replay_energy_journal(data, data.pop(JOURNAL_SEQ_KEY, 0))
+    for serial, totals in data.items():
+        # Ensure all keys exist (migration-safe)
+        for key in ENERGY_DEFAULTS:
+            if key not in totals:
+                totals[key] = ENERGY_DEFAULTS[key]
+        print(f"[*] Loaded energy data for {serial}:")
+        print(f"    PV: {totals['total_pv_kwh']:.2f} kWh")
+        print(f"    Grid Input: {totals['total_grid_input_kwh']:.2f} kWh")
+        print(f"    Load: {totals['total_load_kwh']:.2f} kWh")
+        print(f"    Battery Charge: {totals['total_battery_charge_kwh']:.2f} kWh")
+        print(f"    Battery Discharge: {totals['total_battery_discharge_kwh']:.2f} kWh")
+    return data
+
+journal_seq = 0
+journal_pending = {}  # serial -> kWh increments not yet in the journal
+energy_data = {}  # serial -> totals; filled by main() so importing the module reads no files
+
+def get_energy_totals(serial):
+    """Returns the (shared, mutable) energy totals for one inverter."""
+    with energy_lock:
+        return energy_entry(energy_data, serial)
+
+def add_energy(serial, totals, deltas):
+    """Applies kWh increments to the in-memory totals and queues them for the journal.
+    Caller holds energy_lock."""
+    pending = journal_pending.setdefault(serial, [0.0] * len(ENERGY_DEFAULTS))
+    for i, key in enumerate(ENERGY_DEFAULTS):
+        delta = deltas.get(key, 0.0)
+        totals[key] += delta
+        pending[i] += delta
+
+def pack_energy_journal():
+    """One small record per inverter with new energy since the last call. Caller holds energy_lock."""
+    global journal_seq
+    records = bytearray()
+    for serial, deltas in journal_pending.items():
+        if not any(deltas): continue
+        journal_seq += 1
+        name = serial.encode()
+        body = JOURNAL_HEADER.pack(journal_seq, len(name)) + name + JOURNAL_DELTAS.pack(*deltas)
+        records += body + struct.pack('<I', zlib.crc32(body))
+    journal_pending.clear()
+    return records
+
+def write_energy_journal(records):
+    """Appends packed records and fsyncs them. Caller holds journal_lock."""
+    if not records: return
+    try:
+        fd = os.open(ENERGY_JOURNAL, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, records)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"[!] Energy journal write failed: {e}")
 
-energy_data = load_or_create_energy_data()
+def sync_energy_journal():
+    """Journals the pending energy without holding energy_lock during the fsync.
+    journal_lock is taken before energy_lock is released, so appends stay in sequence order."""
+    with energy_lock:
+        records = pack_energy_journal()
+        journal_lock.acquire()
+    try: write_energy_journal(records)
+    finally: journal_lock.release()
 
 def save_energy_to_disk():
-    """Writes the current energy totals to NAND/Disk safely."""
+    """Compacts the journal: writes the totals to NAND/Disk safely, then empties the journal."""
     with energy_lock:
+        records = pack_energy_journal()
+        body = json.dumps(dict(energy_data, **{JOURNAL_SEQ_KEY: journal_seq}))
+        journal_lock.acquire()
+    try:
+        write_energy_journal(records)
         try:
-            # Atomic write (write temp then rename) prevents corruption on power loss
+            # Atomic write (write temp then rename) prevents corruption on power loss.
+            # The file records the journal position it includes, so a crash before the
+            # journal is emptied cannot count anything twice.
             with open(ENERGY_FILE + ".tmp", 'w') as f:
-                json.dump(energy_data, f, indent=2)
+                f.write(body)
+                f.flush()
+                os.fsync(f.fileno())
             os.replace(ENERGY_FILE + ".tmp", ENERGY_FILE)
+            with open(ENERGY_JOURNAL, 'wb'): pass
         except PermissionError:
             print(f"[!] Energy Save Failed: File is locked or permission denied")
         except IOError as e:
             print(f"[!] Energy Save Failed: I/O error - {e}")
         except Exception as e:
             print(f"[!] Energy Save Failed: {e}")
+    finally:
+        journal_lock.release()
+
+last_save_time = last_sync_time = time.time()
+
+def schedule_energy_save():
+    """Makes the next maybe_save_energy() compact at once. Caller holds energy_lock."""
+    global last_save_time
+    last_save_time = 0.0
+
+def maybe_save_energy(now):
+    """Periodic journal fsync and compaction, shared by all inverter sessions."""
+    global last_save_time, last_sync_time
+    with energy_lock:
+        compact = (now - last_save_time) > SAVE_INTERVAL
+        if not compact and (now - last_sync_time) < JOURNAL_SYNC_INTERVAL: return
+        if compact: last_save_time = now
+        last_sync_time = now
+    if compact: save_energy_to_disk()
+    else: sync_energy_journal()
+
+# Counter -> (power sensor, sign): battery power is positive while charging
+ENERGY_CHANNELS = {
+    "total_pv_kwh": ("pv_input_watt", 1),
+    "total_grid_input_kwh": ("grid_power_watt", 1),
+    "total_load_kwh": ("ac_load_real_watt", 1),
+    "total_battery_charge_kwh": ("batt_power_watt", 1),
+    "total_battery_discharge_kwh": ("batt_power_watt", -1),
+}
+
+def energy_json(totals):
+    """Snapshot keys of the energy counters, rounded as published."""
+    return {"total_pv_energy_kwh" if key == "total_pv_kwh" else key: round(totals[key], 4)
+            for key in ENERGY_DEFAULTS}
 
-def get_empty_data():
+def positive_area(a, b, dt):
+    """Area above zero of the straight line from a to b over dt (trapezoid, split at a sign change)."""
+    if a >= 0 and b >= 0: return (a + b) / 2 * dt
+    if a <= 0 and b <= 0: return 0.0
+    if a > 0: return a * a / (a - b) * dt / 2
+    return b * b / (b - a) * dt / 2
+
+def energy_increments(prev, prev_time, values, now):
+    """kWh since the previous sample; nothing without one, or after a gap too long to bridge."""
+    if prev is None or not 0 < now - prev_time <= ENERGY_MAX_GAP: return {}
+    return integrate_energy(prev, values, now - prev_time)
+
+def integrate_energy(prev, values, dt):
+    """kWh per counter between two samples, interpolating power linearly in between."""
+    deltas = {}
+    for key, (source, sign) in ENERGY_CHANNELS.items():
+        a, b = prev.get(source), values.get(source)
+        if a is None or b is None: continue
+        deltas[key] = positive_area(a * sign, b * sign, dt) / 3600000.0
+    return deltas
+
+# --- DERIVED METRICS ---
+# Short names of the energy counters in the day/month keys, e.g. today_pv_kwh
+ENERGY_SHORT = {key: key[len("total_"):-len("_kwh")] for key in ENERGY_DEFAULTS}
+
+def local_midnight(t, days=0):
+    """Epoch of the local midnight that starts the day of `t`, shifted by `days`."""
+    tm = time.localtime(t)
+    return time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + days, 0, 0, 0, 0, 0, -1))
+
+class RollingMean:
+    """Time-weighted mean over the last `window` seconds. Keeps one trapezoid per sample
+    interval and a running sum, so each sample costs O(1) amortised."""
+    def __init__(self, window):
+        self.window = window
+        self.segments = collections.deque()  # (start, end, area)
+        self.area = 0.0
+        self.last = None
+
+    def add(self, t, value):
+        if self.last is not None:
+            t0, v0 = self.last
+            if not 0 < t - t0 <= ENERGY_MAX_GAP:
+                # Restarted clock or an outage: the old window no longer describes the present
+                self.segments.clear()
+                self.area = 0.0
+            else:
+                area = (v0 + value) / 2 * (t - t0)
+                self.segments.append((t0, t, area))
+                self.area += area
+        self.last = (t, value)
+        while self.segments and self.segments[0][1] <= t - self.window:
+            self.area -= self.segments.popleft()[2]
+
+    def mean(self):
+        if not self.segments: return None
+        return self.area / (self.segments[-1][1] - self.segments[0][0])
+
+class DerivedMetrics:
+    """Today/yesterday/month energy, self-consumption, battery efficiency, peaks and rolling
+    averages of one inverter, updated in O(1) per sample. The day and month state lives in
+    the inverter's energy entry, so it is saved with the totals. Caller holds energy_lock."""
+    def __init__(self, totals, now=None):
+        now = time.time() if now is None else now
+        self.totals = totals
+        self.state = totals.setdefault("derived", {})
+        self.windows = {key: RollingMean(DERIVED_WINDOW) for key in ROLLING_FIELDS}
+        self.next_rollover = 0.0
+        self.roll(now)
+
+    def counters(self):
+        return {key: self.totals[key] for key in ENERGY_DEFAULTS}
+
+    def since(self, start):
+        return {key: self.totals[key] - start.get(key, self.totals[key]) for key in ENERGY_DEFAULTS}
+
+    def roll(self, now):
+        """Starts a new day and/or month bucket if the calendar moved on since the last sample."""
+        state = self.state
+        day, month = time.strftime("%Y-%m-%d", time.localtime(now)), time.strftime("%Y-%m", time.localtime(now))
+        if state.get("day") != day:
+            if state.get("day"):
+                # Yesterday only if it really was the day before (the bridge may have been down)
+                previous = time.strftime("%Y-%m-%d", time.localtime(local_midnight(now) - 1))
+                state["yesterday"] = dict(self.since(state["day_start"]), day=state["day"]) \
+                    if state["day"] == previous else {}
+            state.update(day=day, day_start=self.counters(), day_peaks={})
+            schedule_energy_save()  # Persist the new baseline now, not at the next hourly save
+        if state.get("month") != month:
+            state.update(month=month, month_start=self.counters(), month_peaks={})
+        self.next_rollover = local_midnight(now, 1)
+
+    def add(self, t, values):
+        if t >= self.next_rollover: self.roll(t)
+        state = self.state
+        for key in PEAK_FIELDS:
+            val = values.get(key)
+            if val is None: continue
+            for peaks in (state["day_peaks"], state["month_peaks"]):
+                if val > peaks.get(key, (float("-inf"),))[0]: peaks[key] = (val, round(t, 1))
+        for key, window in self.windows.items():
+            val = values.get(key)
+            if val is not None: window.add(t, val)
+
+    def snapshot(self):
+        """Snapshot keys: today_/month_/yesterday_<counter>_kwh, *_self_consumption_pct,
+        month_battery_efficiency_pct, today_/month_peak_<field> (+ _at), <field>_avg_<N>m."""
+        state, out = self.state, {}
+        buckets = [("today", self.since(state["day_start"])), ("month", self.since(state["month_start"]))]
+        if state.get("yesterday"): buckets.append(("yesterday", state["yesterday"]))
+        for prefix, kwh in buckets:
+            for key, short in ENERGY_SHORT.items():
+                out[f"{prefix}_{short}_kwh"] = round(kwh[key], 3)
+            load = kwh["total_load_kwh"]
+            # The inverter does not export, so the load share not bought from the grid is self-consumption
+            out[f"{prefix}_self_consumption_pct"] = \
+                round(max(0.0, load - kwh["total_grid_input_kwh"]) / load * 100, 1) if load > 0.001 else None
+        month = buckets[1][1]
+        charged = month["total_battery_charge_kwh"]
+        out["month_battery_efficiency_pct"] = \
+            round(month["total_battery_discharge_kwh"] / charged * 100, 1) if charged > 0.01 else None
+        for prefix, peaks in (("today", state["day_peaks"]), ("month", state["month_peaks"])):
+            for key in PEAK_FIELDS:
+                val, at = peaks.get(key, (None, None))
+                out[f"{prefix}_peak_{key}"], out[f"{prefix}_peak_{key}_at"] = val, at
+        for key, window in self.windows.items():
+            mean = window.mean()
+            out[f"{key}_avg_{DERIVED_WINDOW // 60}m"] = None if mean is None else round(mean, 1)
+        return out
+
+def get_empty_data(serial, totals):
     """Initializes sensors to None, energy sensors always available."""
     data = {
+        "inverter_id": serial,
         "fault_code": 0, "fault_msg": "No Fault", "fault_list": [],
         "warning_code": 0, "warning_msg": "No Warning", "warning_list": [],
         "device_status_code": None, "device_status_msg": "Initializing...", 
@@ -136,15 +525,596 @@ def get_empty_data():
         "bulk_charge_volt": None, "float_charge_volt": None, "low_dc_cutoff_volt": None,
         
         # PERSISTENT ENERGY COUNTERS (Always available)
-        "total_pv_energy_kwh": round(energy_data["total_pv_kwh"], 4),
-        "total_grid_input_kwh": round(energy_data["total_grid_input_kwh"], 4),
-        "total_load_kwh": round(energy_data["total_load_kwh"], 4),
-        "total_battery_charge_kwh": round(energy_data["total_battery_charge_kwh"], 4),
-        "total_battery_discharge_kwh": round(energy_data["total_battery_discharge_kwh"], 4)
+        **energy_json(totals),
+
+        # Link state: values are kept across dropouts, `stale` says they are not current
+        "link_state": "offline", "stale": True, "last_update": None,
     }
     return data
 
-latest_data_json = get_empty_data()
+# --- HISTORY (in-memory ring buffers) ---
+def bucket_samples(times, values, step):
+    """[bucket start, min, avg, max] rows for time-ordered samples; NaN values are skipped."""
+    if not times: return []
+    if np is not None: return _buckets_numpy(times, values, step)
+    return _buckets_array(times, values, step)
+
+def _buckets_numpy(times, values, step):
+    t = np.frombuffer(times, dtype=np.float64)
+    v = np.frombuffer(values, dtype=np.float32).astype(np.float64)
+    bucket = np.floor(t / step)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    valid = ~np.isnan(v)
+    n = np.add.reduceat(valid, starts)
+    lo = np.fmin.reduceat(v, starts)
+    hi = np.fmax.reduceat(v, starts)
+    avg = np.add.reduceat(np.where(valid, v, 0.0), starts) / np.maximum(n, 1)
+    keep = n > 0
+    return [[round(b * step, 3), round(a, 3), round(m, 3), round(c, 3)] for b, a, m, c in
+            zip(bucket[starts][keep].tolist(), lo[keep].tolist(), avg[keep].tolist(), hi[keep].tolist())]
+
+def _buckets_array(times, values, step):
+    # Bucket edges by bisection, then C-level min/max/sum over each slice
+    rows, i, n = [], 0, len(times)
+    while i < n:
+        b = math.floor(times[i] / step)
+        j = bisect.bisect_left(times, (b + 1) * step, i)
+        seg = values[i:j]
+        if any(v != v for v in seg): seg = [v for v in seg if v == v]  # Drop NaN gaps
+        if seg:
+            rows.append([round(b * step, 3), round(min(seg), 3), round(sum(seg) / len(seg), 3), round(max(seg), 3)])
+        i = j
+    return rows
+
+def bucket_rollups(rollups, step):
+    """Merges (t, n, min, avg, max) rollup records into coarser rows, weighting avg by n."""
+    rows, cur = [], None
+    for t, n, lo, avg, hi in rollups:
+        if not n or avg != avg: continue
+        b = math.floor(t / step)
+        if cur is None or b != cur[0]:
+            if cur: rows.append([round(cur[0] * step, 3), round(cur[1], 3), round(cur[2] / cur[4], 3), round(cur[3], 3)])
+            cur = [b, lo, 0.0, hi, 0]
+        cur[1], cur[3] = min(cur[1], lo), max(cur[3], hi)
+        cur[2] += avg * n
+        cur[4] += n
+    if cur: rows.append([round(cur[0] * step, 3), round(cur[1], 3), round(cur[2] / cur[4], 3), round(cur[3], 3)])
+    return rows
+
+def bisect_at(at, count, value, lo=0):
+    """First index in [lo, count) whose at(index) >= value, for sorted data that is not a
+    list (bisect's key= needs Python 3.10)."""
+    hi = count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if at(mid) < value: lo = mid + 1
+        else: hi = mid
+    return lo
+
+class History:
+    """Fixed-size ring of realtime samples: one float64 timestamp column plus one float32
+    column per field in HISTORY_FIELDS. Everything is allocated up front, so memory use
+    is constant no matter how long the bridge runs."""
+    def __init__(self, fields=HISTORY_FIELDS, capacity=int(HISTORY_SECONDS / POLL_INTERVAL)):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.columns = {key: array.array('f', bytes(4 * capacity)) for key in fields}
+        self.head = 0   # Next slot to write
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, t, values):
+        """Records one sample; a missing or None value is stored as NaN."""
+        with self.lock:
+            i = self.head
+            self.times[i] = t
+            for key, column in self.columns.items():
+                v = values.get(key)
+                column[i] = math.nan if v is None else v
+            self.head = (i + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def _ordered(self, column, first):
+        """Oldest-first copy of the last count - first samples of one column."""
+        start = (self.head - self.count + first) % self.capacity
+        end = (self.head - 1) % self.capacity + 1
+        if start < end: return column[start:end]
+        return column[start:] + column[:end]
+
+    def window(self, key, since):
+        """(timestamps, values) of every sample newer than `since`, copied out under the lock."""
+        with self.lock:
+            if not self.count: return array.array('d'), array.array('f')
+            oldest = self.head - self.count
+            at = lambda n: self.times[(oldest + n) % self.capacity]
+            lo, hi = 0, self.count  # Binary search on the logical (oldest-first) index
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if at(mid) <= since: lo = mid + 1
+                else: hi = mid
+            if lo == self.count: return array.array('d'), array.array('f')  # Nothing newer
+            return self._ordered(self.times, lo), self._ordered(self.columns[key], lo)
+
+    def query(self, key, seconds, step, now=None):
+        """Downsamples the last `seconds` into [bucket start, min, avg, max] rows; buckets
+        without a valid sample are left out."""
+        now = time.time() if now is None else now
+        times, values = self.window(key, now - seconds)
+        return bucket_samples(times, values, step)
+
+# --- SAMPLE LOG (on-disk, append-only) ---
+LOG_HEADER_SIZE = 512  # JSON header (tier and field layout), padded with spaces
+
+class LogTier:
+    """One resolution of the sample log: fixed-size records appended to dated segment files.
+    Raw records are (t, value...); rollup records are (t, n, min, avg, max per field)."""
+    def __init__(self, directory, name, period, segment_fmt, fields):
+        self.directory, self.name, self.period, self.segment_fmt = directory, name, period, segment_fmt
+        self.fields = fields
+        per_field = 'f' if not period else 'fff'
+        self.record = struct.Struct('<d' + ('' if not period else 'I') + per_field * len(fields))
+        self.header = json.dumps({"tier": name, "period": period, "fields": list(fields)}).encode()
+        self.header = self.header.ljust(LOG_HEADER_SIZE - 1) + b"\n"
+        self.pending = {}   # segment -> bytearray of records not yet on disk
+        self.checked = set()  # Segments whose header was verified by this process
+
+    def segment(self, t):
+        return time.strftime(self.segment_fmt, time.gmtime(t))
+
+    def path(self, segment):
+        return os.path.join(self.directory, f"{self.name}-{segment}.bin")
+
+    def add(self, t, *values):
+        self.pending.setdefault(self.segment(t), bytearray()).extend(self.record.pack(t, *values))
+
+    def flush(self):
+        """One append per touched segment. A torn record from a crash is cut off first."""
+        pending, self.pending = self.pending, {}
+        for segment, data in pending.items():
+            path = self.path(segment)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                if segment not in self.checked:
+                    size = os.fstat(fd).st_size
+                    if size and os.pread(fd, LOG_HEADER_SIZE, 0) != self.header:
+                        # The field layout changed: keep the old file aside and start over
+                        os.close(fd)
+                        os.replace(path, f"{path}.{int(time.time())}.old")
+                        print(f"[!] Sample log: layout of {path} changed, old file set aside")
+                        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+                        size = 0
+                    if not size: os.write(fd, self.header)
+                    elif (size - LOG_HEADER_SIZE) % self.record.size:
+                        os.ftruncate(fd, size - (size - LOG_HEADER_SIZE) % self.record.size)
+                    self.checked.add(segment)
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    def segments(self):
+        """Segment names on disk, oldest first (the date formats sort lexically)."""
+        prefix = self.name + "-"
+        try: names = os.listdir(self.directory)
+        except FileNotFoundError: return []
+        return sorted(n[len(prefix):-4] for n in names if n.startswith(prefix) and n.endswith(".bin"))
+
+    def read(self, start, end, column):
+        """Records with start <= t < end as a list of tuples; only t, n and one field's
+        values are unpacked. Segments are memory-mapped and bisected on t."""
+        k = self.fields.index(column)
+        if not self.period: picker = struct.Struct(f'<d{4 * k}xf{4 * (len(self.fields) - k - 1)}x')
+        else: picker = struct.Struct(f'<dI{12 * k}xfff{12 * (len(self.fields) - k - 1)}x')
+        first, last, out = self.segment(start), self.segment(end), []
+        for segment in self.segments():
+            if not first <= segment <= last: continue
+            with open(self.path(segment), 'rb') as f:
+                try: mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except ValueError: continue  # Empty file
+            with mm:
+                count = (len(mm) - LOG_HEADER_SIZE) // self.record.size
+                at = lambda i: struct.unpack_from('<d', mm, LOG_HEADER_SIZE + i * self.record.size)[0]
+                lo = bisect_at(at, count, start)
+                hi = bisect_at(at, count, end, lo)
+                begin = LOG_HEADER_SIZE + lo * self.record.size
+                out.extend(picker.iter_unpack(mm[begin:LOG_HEADER_SIZE + hi * self.record.size]))
+        return out
+
+    def prune(self, now):
+        """Deletes whole segments whose newest record is older than the retention."""
+        keep = LOG_RETENTION.get(self.name)
+        if keep is None: return
+        for segment in self.segments()[:-1]:  # Never the segment being written
+            path = self.path(segment)
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                count = (size - LOG_HEADER_SIZE) // self.record.size
+                newest = 0.0
+                if count > 0:
+                    f.seek(LOG_HEADER_SIZE + (count - 1) * self.record.size)
+                    newest = struct.unpack('<d', f.read(8))[0]
+            if newest < now - keep:
+                os.remove(path)
+                print(f"[*] Sample log: removed {path} (older than {keep // 86400} days)")
+
+class Rollup:
+    """Running min/sum/max per field for the current period of one rollup tier."""
+    def __init__(self, tier):
+        self.tier = tier
+        self.start = None
+        self.reset()
+
+    def reset(self):
+        width = len(self.tier.fields)
+        self.n, self.count = 0, [0] * width
+        self.lo, self.hi, self.sum = [math.inf] * width, [-math.inf] * width, [0.0] * width
+
+    def add(self, t, values):
+        start = t - t % self.tier.period
+        if start != self.start:
+            self.close()
+            self.start = start
+        self.n += 1
+        for i, v in enumerate(values):
+            if v != v: continue
+            self.count[i] += 1
+            self.sum[i] += v
+            if v < self.lo[i]: self.lo[i] = v
+            if v > self.hi[i]: self.hi[i] = v
+
+    def close(self):
+        """Writes out the current period (also a partial one at shutdown)."""
+        if self.start is None or not self.n: return
+        out = []
+        for c, lo, total, hi in zip(self.count, self.lo, self.sum, self.hi):
+            out += (lo, total / c, hi) if c else (math.nan,) * 3
+        self.tier.add(self.start, self.n, *out)
+        self.reset()
+
+class SampleLog:
+    """Append-only binary log of realtime samples for one inverter, with 1 min and 1 h rollups.
+    The poll thread only queues samples; the log writer thread packs and appends them."""
+    def __init__(self, serial, fields=HISTORY_FIELDS):
+        directory = os.path.join(LOG_DIR, serial)
+        os.makedirs(directory, exist_ok=True)
+        self.fields = fields
+        self.tiers = [LogTier(directory, "raw", 0, "%Y%m%d", fields),
+                      LogTier(directory, "1m", 60, "%Y%m", fields),
+                      LogTier(directory, "1h", 3600, "%Y", fields)]
+        self.rollups = [Rollup(tier) for tier in self.tiers[1:]]
+        self.samples = []
+        self.lock = threading.Lock()      # Guards samples (poll thread vs writer)
+        self.io_lock = threading.Lock()   # One flush at a time (writer thread vs shutdown)
+
+    def append(self, t, values):
+        sample = [math.nan if values.get(key) is None else values[key] for key in self.fields]
+        with self.lock:
+            self.samples.append((t, sample))
+
+    def flush(self, final=False):
+        with self.io_lock:
+            with self.lock:
+                samples, self.samples = self.samples, []
+            raw = self.tiers[0]
+            for t, values in samples:
+                raw.add(t, *values)
+                for rollup in self.rollups: rollup.add(t, values)
+            if final:
+                for rollup in self.rollups: rollup.close()
+            for tier in self.tiers: tier.flush()
+
+    def prune(self, now):
+        with self.io_lock:
+            for tier in self.tiers: tier.prune(now)
+
+    def query(self, key, start, end, step):
+        """Rows from the coarsest tier that still resolves `step` and still covers `start`."""
+        now = time.time()
+        i = max(sum(1 for tier in self.tiers if tier.period <= step) - 1, 0)
+        for tier in self.tiers[i:]:
+            keep = LOG_RETENTION.get(tier.name)
+            if keep is None or start >= now - keep: break
+        records = tier.read(start, end, key)
+        if not tier.period:
+            rows = bucket_samples(array.array('d', [r[0] for r in records]),
+                                  array.array('f', [r[1] for r in records]), step)
+        else:
+            rows = bucket_rollups(records, step)
+        return tier.name, rows
+
+def sample_log_writer():
+    """Flushes every inverter's sample log in one batch per LOG_FLUSH_INTERVAL."""
+    last_prune = 0.0
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        with inverters_lock:
+            logs = [inv.log for inv in inverters.values()]
+        now = time.time()
+        for log in logs:
+            try:
+                log.flush()
+                if now - last_prune > 3600: log.prune(now)
+            except OSError as e:
+                print(f"[!] Sample log flush failed: {e}")
+        if now - last_prune > 3600: last_prune = now
+
+# --- FAULT EVENTS ---
+class EventJournal:
+    """Raise and clear transitions of every fault and warning bit of one inverter. The newest
+    EVENT_JOURNAL_SIZE events stay in memory for queries; each one is also appended to
+    <LOG_DIR>/<serial>/events.jsonl as it happens, and the file is rewritten to the same
+    bound once it holds twice as many. The poll thread appends; control clients read."""
+    def __init__(self, serial):
+        self.serial = serial
+        self.path = os.path.join(LOG_DIR, serial, "events.jsonl")
+        self.events = collections.deque(maxlen=EVENT_JOURNAL_SIZE)
+        self.lock = threading.Lock()
+        self.codes = {}   # Field key -> last code seen; restored from the newest event
+        self.since = {}   # (kind, bit) -> time the bit was raised, for durations
+        self.lines = 0    # Lines in the file, compacted at 2 * EVENT_JOURNAL_SIZE
+        self.seq = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f: data = f.read()
+        except FileNotFoundError: return
+        lines = data.splitlines()
+        for line in lines:
+            try: self.events.append(json.loads(line))
+            except ValueError: pass  # Torn last line from a power cut
+        # A torn tail would swallow the next append: rewrite the file with the next event instead
+        self.lines = len(lines) if data.endswith(b"\n") else 2 * EVENT_JOURNAL_SIZE
+        if self.events:
+            last = self.events[-1]
+            self.seq = last["seq"]
+            self.codes = dict(last["codes"])
+            for event in self.events:
+                if event["state"] == "raised": self.since[event["kind"], event["bit"]] = event["t"]
+                else: self.since.pop((event["kind"], event["bit"]), None)
+
+    def observe(self, t, values, latest):
+        """Compares the flag codes in freshly decoded `values` with the last ones and journals
+        every bit that changed, with the EVENT_CONTEXT_FIELDS from `values` or else from the
+        `latest` realtime sample. Returns the new events (usually none)."""
+        new = []
+        for key, kind in REGISTER_MAP.flag_fields:
+            code = values.get(key)
+            if code is None: continue
+            old = self.codes.get(key, 0)
+            if code == old: continue
+            self.codes[key] = code
+            names = FLAG_TABLES[kind].names
+            for bit in set_bits(old ^ code):
+                raised = bool((code >> bit) & 1)
+                event = {"t": round(t, 3), "kind": kind, "bit": bit, "message": names[bit],
+                         "state": "raised" if raised else "cleared"}
+                if raised: self.since[kind, bit] = t
+                else:
+                    started = self.since.pop((kind, bit), None)
+                    if started is not None: event["duration_s"] = round(t - started, 3)
+                new.append(event)
+        if not new: return new
+        snapshot = {key: values.get(key, latest.get(key)) for key in EVENT_CONTEXT_FIELDS}
+        lines = []
+        with self.lock:
+            for event in new:
+                self.seq += 1
+                event.update(seq=self.seq, codes=dict(self.codes), values=snapshot)
+                self.events.append(event)
+                lines.append(json.dumps(event))
+        for event in new:
+            print(f"[!] {self.serial}: {event['message']} {event['state']}")
+        try: self.write(lines)
+        except OSError as e: print(f"[!] Event journal write failed: {e}")
+        return new
+
+    def write(self, lines):
+        """Appends and fsyncs: events are rare and should survive the power cut they may announce."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.lines + len(lines) > 2 * EVENT_JOURNAL_SIZE:
+            with self.lock: lines = [json.dumps(event) for event in self.events]
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.lines = len(lines)
+            return
+        with open(self.path, 'a') as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.lines += len(lines)
+
+    def query(self, start=None, end=None):
+        """Events with start <= t < end, oldest first."""
+        with self.lock: events = list(self.events)
+        at = lambda i: events[i]["t"]
+        lo = 0 if start is None else bisect_at(at, len(events), start)
+        hi = len(events) if end is None else bisect_at(at, len(events), end, lo)
+        return events[lo:hi]
+
+# --- PER-INVERTER SESSION STATE ---
+class Snapshot:
+    """Immutable, pre-encoded view of one inverter, published once per poll cycle.
+    `data` is never mutated after publishing, so it is safe to share between readers."""
+    __slots__ = ("generation", "data", "encoded", "gzipped")
+
+    def __init__(self, generation, data, encoded):
+        self.generation = generation
+        self.data = data
+        self.encoded = encoded
+        self.gzipped = None  # `encoded` compressed on the first HTTP request that accepts gzip
+
+class Inverter:
+    """Everything that belongs to one dongle: socket, Modbus lock, energy and JSON."""
+    def __init__(self, serial):
+        self.serial = serial
+        self.conn = None
+        self.link = None  # ModbusLink wrapping conn
+        self.addr = None
+        self.connected_at = 0
+        self.fast_start = False  # Answered Modbus right after the handshake: SETTLE_DELAY not needed
+        self.needs_settle = False  # Failed a read without SETTLE_DELAY: always pause for this dongle
+        self.modbus_lock = threading.Lock()  # Serializes request/response pairs on this dongle only
+        self.write_queue = []         # WriteRequests waiting for the poll thread
+        self.write_lock = threading.Lock()
+        self.writes_open = False      # A session will run the queue; only changed under write_lock
+        self.wakeup = threading.Event()  # Cuts the poll loop's idle sleep short for queued writes
+        self.burst = None  # Latest Burst requested with BURST, kept for BURST_DATA
+        self.profile = load_profile(serial)  # RegisterProfile from --scan, or None
+        self.energy = get_energy_totals(serial)
+        self.history = History()
+        self.log = SampleLog(serial)
+        self.events = EventJournal(serial)
+        self.capture = FrameCapture(serial) if CAPTURE_DIR else None
+        self.data_lock = threading.Lock()  # Guards latest_data_json (the poll thread's working copy)
+        self.latest_data_json = get_empty_data(serial, self.energy)
+        with energy_lock:
+            self.derived = DerivedMetrics(self.energy)
+            self.latest_data_json.update(self.derived.snapshot())
+        self.generation = 0
+        self.snapshot = None
+        self.publish_snapshot()
+
+    def publish_snapshot(self):
+        """Freezes latest_data_json into a new Snapshot. Caller holds data_lock."""
+        self.generation += 1
+        data = dict(self.latest_data_json, generation=self.generation)
+        # Readers only ever see a whole Snapshot: the attribute swap is atomic
+        self.snapshot = Snapshot(self.generation, data, json.dumps(data).encode())
+
+def get_or_create_inverter(serial):
+    with inverters_lock:
+        inv = inverters.get(serial)
+        if inv is None:
+            inv = inverters[serial] = Inverter(serial)
+        return inv
+
+def find_inverter(inv_id=None):
+    """Resolve a control-protocol id. Without an id, only an unambiguous single unit matches."""
+    with inverters_lock:
+        if inv_id:
+            for serial, inv in inverters.items():
+                if serial.upper() == inv_id.upper(): return inv
+            return None
+        online = [inv for inv in inverters.values() if inv.conn]
+        if len(online) == 1: return online[0]
+        if len(inverters) == 1: return next(iter(inverters.values()))
+        return None
+
+def offline_json():
+    """JSON for the default target while no dongle has connected yet: the empty snapshot,
+    with the totals on disk when they belong to a single inverter. None once any is known."""
+    with inverters_lock:
+        if inverters: return None
+    with energy_lock:
+        known = list(energy_data.items())
+        serial, totals = known[0] if len(known) == 1 else (None, ENERGY_DEFAULTS)
+        data = dict(get_empty_data(None if serial == LEGACY_ENERGY_KEY else serial, totals), generation=0)
+    return json.dumps(data).encode()
+
+def parse_dongle_serial(reply, addr):
+    """Extract the PN from the AT+DTUPN? reply (e.g. '+ok=E50000231234567'), fallback to the IP."""
+    text = reply.decode(errors='ignore').strip()
+    if "=" in text: text = text.split("=", 1)[1]
+    serial = "".join(ch for ch in text if ch.isalnum())
+    return serial or addr[0]
+
+# --- METRICS (Prometheus text format) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+COMMAND_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25, 1.0, 5.0, 10.0)
+HANDSHAKE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 2.0, 5.0)
+METRICS = []  # Every metric in exposition order
+
+def format_labels(names, values):
+    if not names: return ""
+    pairs = (f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    """Value per label tuple. Recording is one dict update under an uncontended lock."""
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self.values = {}
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        with self.lock: items = sorted(self.values.items())
+        for labels, value in items:
+            yield f"{self.name}{format_labels(self.labels, labels)} {value}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, labels, value):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_max(self, labels, value):
+        with self.lock:
+            if value > self.values.get(labels, 0): self.values[labels] = value
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None: entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def expose(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock: items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        for labels, (counts, total) in items:
+            running = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                running += count
+                yield f"{self.name}_bucket{format_labels(self.labels + ('le',), labels + (bound,))} {running}"
+            yield f"{self.name}_sum{format_labels(self.labels, labels)} {total:.6f}"
+            yield f"{self.name}_count{format_labels(self.labels, labels)} {running}"
+
+MODBUS_REQUESTS = Counter("bridge_modbus_requests_total", "Modbus requests by block and result (ok, timeout, exception, error).",
+                          ("inverter", "block", "result"))
+MODBUS_LATENCY = Histogram("bridge_modbus_response_seconds", "Send-to-response time of answered Modbus requests.",
+                           ("inverter", "block"))
+MODBUS_CRC_ERRORS = Counter("bridge_modbus_crc_errors_total", "Candidate frames dropped for a bad CRC.", ("inverter",))
+MODBUS_EXCEPTIONS = Counter("bridge_modbus_exception_replies_total", "Modbus exception replies by exception code.",
+                            ("inverter", "code"))
+POLL_ERRORS = Counter("bridge_poll_errors_total", "Unexpected errors raised while polling, by type.", ("inverter", "error"))
+FAILURE_STREAK = Gauge("bridge_poll_failure_streak", "Consecutive failed realtime reads right now.", ("inverter",))
+FAILURE_STREAK_MAX = Gauge("bridge_poll_failure_streak_max", "Longest run of failed realtime reads since start.", ("inverter",))
+CONNECTIONS = Counter("bridge_dongle_sessions_total", "Dongle sessions started.", ("inverter",))
+RECONNECTS = Counter("bridge_dongle_reconnects_total", "Sessions started by an inverter that had connected before.", ("inverter",))
+HANDSHAKE = Histogram("bridge_handshake_seconds", "AT+DTUPN? handshake duration, including the settle pause.",
+                      buckets=HANDSHAKE_BUCKETS)
+HANDSHAKE_FAILURES = Counter("bridge_handshake_failures_total", "Dongle connections dropped during the handshake.")
+COMMAND_LATENCY = Histogram("bridge_control_command_seconds",
+                            "Control command latency until the reply is ready (writes: until verified).",
+                            ("command",), buckets=COMMAND_BUCKETS)
+
+def render_metrics():
+    return ("\n".join(line for metric in METRICS for line in metric.expose()) + "\n").encode()
 
 # --- MODBUS HELPERS ---
 def modbus_crc(data):
@@ -156,351 +1126,1755 @@ def modbus_crc(data):
             else: crc >>= 1
     return struct.pack('<H', crc)
 
-def to_signed(val):
-    return val - 65536 if val >= 32768 else val
-
-def build_write_packet(reg, value):
-    payload = struct.pack('>BBHHB', 1, 16, reg, 1, 2) + struct.pack('>H', value)
+def build_write_packet(reg, values):
+    """Function 16 frame writing one value or a list of consecutive register values."""
+    if isinstance(values, int): values = [values]
+    payload = struct.pack('>BBHHB', 1, 16, reg, len(values), len(values) * 2)
+    payload += struct.pack(f'>{len(values)}H', *values)
     return payload + modbus_crc(payload)
 
 def build_read_packet(start, count):
     payload = struct.pack('>BBHH', 1, 3, start, count)
     return payload + modbus_crc(payload)
 
-def flush_buffer(conn):
+# --- REGISTER MAP COMPILER ---
+FLAG_TABLES = {
+    "fault": FlagTable(FAULT_BIT_MAP, "Unknown F", "No Fault"),
+    "warning": FlagTable(WARNING_BIT_MAP, "Unknown W", "No Warning"),
+}
+
+class RegisterField:
+    """One JSON key decoded from one (u16) or two (u32, high word first) registers."""
+    def __init__(self, spec):
+        self.addr = spec["addr"]
+        self.key = spec["key"]
+        self.width = 2 if spec.get("type", "u16") == "u32" else 1
+        self.fmt = ("Ii" if self.width == 2 else "Hh")[bool(spec.get("signed"))]
+        self.div = spec.get("div")
+        self.writable = spec.get("writable", False)
+        self.aliases = spec.get("aliases", [])
+        self.enum = {int(k): v for k, v in spec["enum"].items()} if "enum" in spec else None
+        self.enum_key = spec.get("enum_key", self.key + "_msg")
+        self.enum_default = spec.get("enum_default", "Unknown ({value})")
+        self.flags = spec.get("flags")
+        self.min, self.max = spec.get("min"), spec.get("max")  # Accepted write range (engineering units)
+
+    def encode(self, value):
+        """Engineering value -> raw register value for a write. Raises ValueError for a value
+        outside the field's min/max or one that does not fit the register."""
+        if (self.min is not None and value < self.min) or (self.max is not None and value > self.max):
+            raise ValueError(f"{self.key} must be within {self.min}..{self.max}")
+        raw = int(round(value * self.div)) if self.div else int(value)
+        low, high = (-0x8000, 0x7FFF) if self.fmt == "h" else (0, 0xFFFF)
+        if not low <= raw <= high: raise ValueError(f"{value} does not fit register {self.addr}")
+        return raw & 0xFFFF
+
+    def decode_raw(self, raw):
+        """Single raw register value -> engineering value (used for write read-backs)."""
+        if self.fmt == "h" and raw >= 0x8000: raw -= 0x10000
+        return raw / self.div if self.div else raw
+
+    def expand(self, out):
+        """Adds the alias, enum text and bit-list keys that hang off this field."""
+        val = out[self.key]
+        for alias in self.aliases: out[alias] = val
+        if self.enum is not None:
+            out[self.enum_key] = self.enum.get(val, self.enum_default.format(value=val))
+        if self.flags:
+            out[self.flags + "_list"], out[self.flags + "_msg"] = FLAG_TABLES[self.flags].decode(val)
+
+class RegisterBlock:
+    """A contiguous read, compiled once into its request frame and a single struct format."""
+    def __init__(self, name, group, start, count, fields, parts=None):
+        self.name = name
+        self.group = group
+        self.start = start
+        self.count = count
+        self.fields = sorted(fields, key=lambda f: f.addr)
+        self.parts = parts or [self]  # Declared blocks this read was coalesced from
+
+        fmt, pos, end = ">", self.start, self.start + self.count
+        for f in self.fields:
+            if f.addr < pos or f.addr + f.width > end:
+                raise ValueError(f"register {f.addr} ({f.key}) overlaps or lies outside block {self.name}")
+            if f.addr > pos: fmt += f"{(f.addr - pos) * 2}x"  # Unmapped registers are skipped
+            fmt += f.fmt
+            pos = f.addr + f.width
+        if end > pos: fmt += f"{(end - pos) * 2}x"
+
+        self.struct = struct.Struct(fmt)
+        self.request = build_read_packet(self.start, self.count)
+        self.plan = [(f.key, f.div) for f in self.fields]
+        self.extras = [f for f in self.fields if f.aliases or f.enum is not None or f.flags]
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(spec["name"], spec.get("group", "realtime"), spec["start"], spec["count"],
+                   [RegisterField(f) for f in spec["fields"]])
+
+    def decode(self, raw):
+        out = {key: (val / div if div else val) for (key, div), val in zip(self.plan, self.struct.unpack(raw))}
+        for f in self.extras: f.expand(out)
+        return out
+
+def coalesce_blocks(blocks, max_registers=MAX_READ_REGISTERS, max_gap=MAX_COALESCE_GAP, name=None, profile=None):
+    """Merges nearby declared blocks into as few reads as the dongle's size limit allows.
+    Merged reads are named after their parts unless `name` is given. With a scanned
+    RegisterProfile, a merged read never spans a register the dongle rejected."""
+    merged, run = [], []
+    for block in sorted(blocks, key=lambda b: b.start):
+        if run:
+            start, end = run[0].start, max(b.start + b.count for b in run)
+            if (block.start - end) <= max_gap and (block.start + block.count - start) <= max_registers \
+                    and (profile is None or profile.covers(start, block.start + block.count)):
+                run.append(block); continue
+            merged.append(run)
+        run = [block]
+    if run: merged.append(run)
+
+    out = []
+    for run in merged:
+        if len(run) == 1:
+            out.append(run[0]); continue
+        start = run[0].start
+        end = max(b.start + b.count for b in run)
+        out.append(RegisterBlock(name or "+".join(b.name for b in run), run[0].group, start, end - start,
+                                 [f for b in run for f in b.fields], parts=run))
+    return out
+
+def split_block(block, max_registers):
+    """Declared block -> reads of at most max_registers, cut between fields."""
+    if block.count <= max_registers: return [block]
+    pieces, fields = [], []
+    for f in block.fields:
+        if fields and f.addr + f.width - fields[0].addr > max_registers:
+            pieces.append(fields); fields = []
+        fields.append(f)
+    if fields: pieces.append(fields)
+    return [RegisterBlock(f"{block.name}.{i + 1}", block.group, p[0].addr, p[-1].addr + p[-1].width - p[0].addr, p)
+            for i, p in enumerate(pieces)]
+
+class RegisterMap:
+    def __init__(self, path):
+        with open(path, 'r') as f:
+            spec = json.load(f)
+        self.name = spec.get("name", os.path.basename(path))
+        self.blocks = [RegisterBlock.from_spec(b) for b in spec["blocks"]]
+        self.fields = {f.key: f for b in self.blocks for f in b.fields}
+        self.flag_fields = [(f.key, f.flags) for f in self.fields.values() if f.flags]  # Watched by EventJournal
+        self.writable = {a for f in self.fields.values() if f.writable for a in range(f.addr, f.addr + f.width)}
+        self.adhoc = {}
+
+    def group(self, name):
+        return [b for b in self.blocks if b.group == name]
+
+    def groups(self):
+        return list(dict.fromkeys(b.group for b in self.blocks))
+
+    def block_for(self, start, count):
+        """A block decoding every mapped field inside an arbitrary read, e.g. one taken
+        from a capture made with an older map. Compiled once per (start, count)."""
+        block = self.adhoc.get((start, count))
+        if block is None:
+            end = start + count
+            owners = [b for b in self.blocks if any(start <= f.addr and f.addr + f.width <= end for f in b.fields)]
+            fields = [f for b in owners for f in b.fields if start <= f.addr and f.addr + f.width <= end]
+            groups = [b.group for b in owners]
+            group = "realtime" if "realtime" in groups else (groups[0] if groups else None)
+            block = self.adhoc[(start, count)] = RegisterBlock(f"{start}+{count}", group, start, count, fields)
+        return block
+
+REGISTER_MAP = RegisterMap(REGISTER_MAP_FILE)
+print(f"[*] Register map: {REGISTER_MAP.name} ({len(REGISTER_MAP.blocks)} blocks)")
+
+def derive_realtime(values):
+    """Sensors computed from decoded realtime registers (see Derived Sensors Map in README)."""
+    v_batt = values.get("batt_volt")
+    if v_batt is not None and v_batt < 10.0:
+        values["batt_volt"] = v_batt = 48.0 # Protection from v89
+    v_grid, p_grid = values.get("grid_volt"), values.get("grid_power_watt")
+    if v_grid is not None and p_grid is not None:
+        values["grid_current"] = round(p_grid / v_grid, 1) if v_grid > 0 else 0.0
+    v_pv, p_pv = values.get("pv_input_volt"), values.get("pv_input_watt")
+    if v_pv is not None and p_pv is not None:
+        values["pv_current"] = round(p_pv / v_pv, 2) if v_pv > 0 else 0.0
+    if "ac_load_va" in values:
+        values["ac_load_pct"] = round(min((values["ac_load_va"] / INVERTER_RATED_WATT) * 100, 300), 1)
+
+    # --- CRITICAL FIX: TRUE BATTERY CURRENT (From v89) ---
+    # Register 232 = Net Battery Current (Solar + Grid - Load), "Positive number means charging"
+    # True Battery Power (Watts) uses the protected battery voltage
+    if v_batt is not None and "batt_current" in values:
+        values["batt_power_watt"] = int(values["batt_current"] * v_batt)
+    return values
+
+# --- MODBUS RTU FRAME ASSEMBLER ---
+# The dongle forwards RTU frames over TCP unchanged, so a response can arrive split across
+# segments or glued to stale bytes. Frames are delimited by their length and CRC instead.
+class ModbusLink:
+    """Buffered Modbus RTU request/response on one dongle socket."""
+    def __init__(self, conn, slave_id=1, capture=None, serial=""):
+        self.conn = conn
+        self.serial = serial  # Metrics label
+        self.slave_id = slave_id
+        self.capture = capture  # FrameCapture recording both directions, or None
+        self.buf = bytearray()
+        self.last_exception = None  # Exception code of the last reply, None if it was not one
+        self.unanswered_since = None  # Monotonic time of the first request sent since bytes last arrived
+
+    def silence(self):
+        """Seconds the dongle has left requests without a single byte in return."""
+        return 0.0 if self.unanswered_since is None else time.monotonic() - self.unanswered_since
+
+    def discard_pending(self):
+        """Drop stale bytes (late replies, write echoes) without waiting for more."""
+        self.buf.clear()
+        try:
+            self.conn.setblocking(False)
+            while True:
+                data = self.conn.recv(4096)
+                if not data: break
+                self.unanswered_since = None
+                if self.capture: self.capture.record(CAP_RX, data)
+        except (BlockingIOError, InterruptedError): pass
+        finally: self.conn.setblocking(True)
+
+    def send(self, packet):
+        if self.capture: self.capture.record(CAP_TX, packet)
+        if self.unanswered_since is None: self.unanswered_since = time.monotonic()
+        self.conn.sendall(packet)
+
+    def receive(self, timeout):
+        self.conn.settimeout(timeout)
+        data = self.conn.recv(1024)
+        if not data: raise ConnectionError("dongle closed the connection")
+        self.unanswered_since = None
+        if self.capture: self.capture.record(CAP_RX, data)
+        self.buf += data
+
+    def extract_frame(self, fc, count):
+        """Return (fc, body) of the first complete valid frame, (None, None) if incomplete.
+        Garbage or CRC failures are skipped one byte at a time until the stream resyncs."""
+        buf = self.buf
+        while len(buf) >= 5:
+            if buf[0] != self.slave_id:
+                del buf[0]; continue
+            rx_fc = buf[1]
+            if rx_fc == fc | 0x80: size = 5                                  # Exception reply
+            elif rx_fc == 3 == fc and buf[2] == count * 2: size = 5 + buf[2]
+            elif rx_fc == 16 == fc: size = 8                                 # Echo of start + count
+            else:
+                del buf[0]; continue
+            if len(buf) < size: return None, None
+            if modbus_crc(buf[:size - 2]) != buf[size - 2:size]:
+                MODBUS_CRC_ERRORS.inc((self.serial,))
+                del buf[0]; continue
+            frame = bytes(buf[:size])
+            del buf[:size]
+            return rx_fc, frame[2:-2]
+        return None, None
+
+def read_modbus_response(link, fc=3, count=0, timeout=MODBUS_TIMEOUT):
+    """Waits until a complete frame is assembled or the per-request deadline passes.
+    Returns the raw register bytes (fc 3), the echoed start/count (fc 16), or None on
+    timeout/exception reply."""
+    deadline = time.monotonic() + timeout
+    link.last_exception = None
+    while True:
+        rx_fc, body = link.extract_frame(fc, count)
+        if rx_fc is not None:
+            if rx_fc & 0x80:
+                link.last_exception = body[0]
+                return None
+            return body if rx_fc == 16 else body[1:]
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: return None
+        try: link.receive(remaining)
+        except socket.timeout: return None
+
+def modbus_request(link, packet, fc, count=0, timeout=MODBUS_TIMEOUT, name="other"):
+    """One request/response exchange, counted per `name` (the block) in the metrics."""
+    started, result = time.perf_counter(), "error"
+    try:
+        link.discard_pending()
+        link.send(packet)
+        body = read_modbus_response(link, fc, count, timeout)
+        if body is not None:
+            result = "ok"
+            MODBUS_LATENCY.observe((link.serial, name), time.perf_counter() - started)
+        elif link.last_exception is not None:
+            result = "exception"
+            MODBUS_EXCEPTIONS.inc((link.serial, str(link.last_exception)))
+        else:
+            result = "timeout"
+        return body
+    finally:
+        MODBUS_REQUESTS.inc((link.serial, name, result))
+
+def modbus_read_block(link, block):
+    """Reads and decodes one compiled block; None if the dongle did not answer cleanly."""
+    raw = modbus_request(link, block.request, 3, block.count, name=block.name)
+    if raw is None: return None
+    return block.decode(raw)
+
+# --- FRAME CAPTURE & REPLAY ---
+CAPTURE_MAGIC = b"IBCAP1\n"
+CAPTURE_RECORD = struct.Struct('<BdH')  # kind, monotonic time, data length; the data follows
+CAP_RX, CAP_TX, CAP_SESSION, CAP_ANCHOR = 0, 1, 2, 3
+# SESSION (new dongle connection) and ANCHOR (start of a rotated file) carry the wall-clock
+# time ('<d') of the same instant, so monotonic times can be turned back into dates.
+
+class FrameCapture:
+    """Rotating binary record of every byte exchanged with one dongle."""
+    def __init__(self, serial):
+        self.path = os.path.join(CAPTURE_DIR, f"{serial}.cap")
+        self.file = None
+        self.failed = False
+        self.last_flush = 0.0
+        self.lock = threading.Lock()  # A replaced session may still be writing
+
+    def open(self):
+        os.makedirs(CAPTURE_DIR, exist_ok=True)
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0: self.file.write(CAPTURE_MAGIC)
+        self.write(CAP_ANCHOR, struct.pack('<d', time.time()))
+
+    def write(self, kind, data, t=None):
+        self.file.write(CAPTURE_RECORD.pack(kind, time.monotonic() if t is None else t, len(data)) + data)
+
+    def record(self, kind, data):
+        with self.lock:
+            if self.failed: return
+            try:
+                if self.file is None: self.open()
+                self.write(kind, data)
+                if self.file.tell() >= CAPTURE_MAX_BYTES: self.rotate()
+                elif time.monotonic() - self.last_flush > 5.0:
+                    self.file.flush()
+                    self.last_flush = time.monotonic()
+            except OSError as e:
+                print(f"[!] Capture to {self.path} failed, capture stopped: {e}")
+                self.failed = True
+
+    def flush(self):
+        with self.lock:
+            if self.file: self.file.flush()
+
+    def session(self):
+        self.record(CAP_SESSION, struct.pack('<d', time.time()))
+
+    def rotate(self):
+        self.file.close()
+        for i in range(CAPTURE_KEEP - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"): os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self.open()
+
+def capture_files(path):
+    """A capture and its rotated predecessors, oldest first."""
+    older = [f"{path}.{i}" for i in range(CAPTURE_KEEP, 0, -1) if os.path.exists(f"{path}.{i}")]
+    return older + [path]
+
+def read_capture(paths):
+    """Yields (kind, monotonic time, data) from capture files in order; stops at a torn tail."""
+    for path in paths:
+        with open(path, 'rb') as f: raw = f.read()
+        if not raw.startswith(CAPTURE_MAGIC): raise ValueError(f"{path} is not a frame capture")
+        pos = len(CAPTURE_MAGIC)
+        while pos + CAPTURE_RECORD.size <= len(raw):
+            kind, t, size = CAPTURE_RECORD.unpack_from(raw, pos)
+            pos += CAPTURE_RECORD.size
+            if pos + size > len(raw): break
+            yield kind, t, raw[pos:pos + size]
+            pos += size
+
+class ReplayLink(ModbusLink):
+    """A ModbusLink fed from capture records: bytes the dongle sent arrive in the same
+    chunks, and a read that timed out live times out here when the next request shows up.
+    File anchors are absorbed on the way, so a rotation mid-exchange is invisible."""
+    def __init__(self, records):
+        super().__init__(None, serial="replay")
+        self.records = records
+        self.anchor = None  # (monotonic, wall clock) of the latest SESSION or ANCHOR record
+        self.now = 0.0
+        self.next = self.pull()
+
+    def pull(self):
+        for record in self.records:
+            if record[0] != CAP_ANCHOR: return record
+            self.anchor = (record[1], struct.unpack('<d', record[2])[0])
+        return None
+
+    def advance(self):
+        kind, self.now, data = self.next
+        if kind == CAP_SESSION: self.anchor = (self.now, struct.unpack('<d', data)[0])
+        self.next = self.pull()
+        return kind, data
+
+    def discard_pending(self):
+        self.buf.clear()
+        while self.next and self.next[0] == CAP_RX: self.advance()
+
+    def send(self, packet):
+        self.advance()  # The recorded request; the caller passes the same bytes
+
+    def receive(self, timeout):
+        if not self.next or self.next[0] != CAP_RX: raise socket.timeout()
+        self.buf += self.advance()[1]
+
+def replay_capture(paths, samples_out=None):
+    """Runs a capture through the live decode path (read_modbus_response, the register map,
+    derive_realtime, integrate_energy) as fast as possible. Returns the replay statistics
+    and the kWh the bridge would have counted."""
+    link = ReplayLink(read_capture(paths))
+    totals = ENERGY_DEFAULTS.copy()
+    stats = {"requests": 0, "replies": 0, "timeouts": 0, "exceptions": 0, "sessions": 0, "samples": 0}
+    first = None
+    last_sample, last_sample_time = None, 0.0
+    started = time.perf_counter()
+    while link.next:
+        kind, t, packet = link.next
+        if first is None: first = t
+        if kind == CAP_SESSION:
+            link.advance()
+            stats["sessions"] += 1
+            last_sample = None  # A new connection starts a new poll loop
+            continue
+        if kind != CAP_TX or len(packet) < 6:
+            link.advance()  # Bytes from before the first request
+            continue
+        fc, (start, count) = packet[1], struct.unpack('>HH', packet[2:6])
+        stats["requests"] += 1
+        body = modbus_request(link, packet, fc, count if fc == 3 else 0, name="replay")
+        if body is None:
+            stats["exceptions" if link.last_exception is not None else "timeouts"] += 1
+            continue
+        stats["replies"] += 1
+        if fc != 3: continue
+        block = REGISTER_MAP.block_for(start, count)
+        values = block.decode(body)
+        if block.group != "realtime": continue
+        derive_realtime(values)
+        for key, delta in energy_increments(last_sample, last_sample_time, values, link.now).items():
+            totals[key] += delta
+        last_sample, last_sample_time = values, link.now
+        stats["samples"] += 1
+        if samples_out:
+            wall = link.anchor[1] + (link.now - link.anchor[0]) if link.anchor else link.now
+            samples_out.write(json.dumps(dict(values, t=round(wall, 3))) + "\n")
+    stats["span_s"] = round(link.now - first, 1) if first is not None else 0.0
+    stats["replay_s"] = round(time.perf_counter() - started, 2)
+    return stats, totals
+
+# --- WRITE QUEUE ---
+class WriteRequest:
+    __slots__ = ("field", "value", "raw", "future")
+
+    def __init__(self, field, value, future):
+        self.field = field
+        self.value = value
+        self.raw = field.encode(value)
+        self.future = future
+
+def resolve(future, reply):
+    if not future.done(): future.set_result(reply)
+
+def queue_write(inv, key, val):
+    """Queues a setting for the poll thread; returns a Future resolving to the reply line."""
+    future = concurrent.futures.Future()
+    # Address and scaling come from the register map, not from the command
+    field = REGISTER_MAP.fields.get(key)
+    if field is None or not field.writable:
+        resolve(future, f"ERR {key} is not writable in {REGISTER_MAP.name}")
+    else:
+        request = WriteRequest(field, val, future)
+        # Checked under the lock fail_pending_writes takes, so a write can never slip into
+        # the queue of a session that is being torn down
+        with inv.write_lock:
+            queued = inv.writes_open
+            if queued: inv.write_queue.append(request)
+        if queued: inv.wakeup.set()
+        else: resolve(future, "ERR inverter offline")
+    return future
+
+def plan_write_frames(requests, writable):
+    """Groups queued writes into as few function-16 frames as possible. Registers between
+    two writes may be re-written with their current value, but only mapped writable ones
+    (`writable`, a set of addresses); otherwise a new frame starts. Returns
+    [(start, [raw value, or None for a gap], [requests])]; run_pending_writes fills the
+    gaps from a read taken right before the frame goes out."""
+    by_addr = {}
+    for req in requests: by_addr.setdefault(req.field.addr, []).append(req)
+    frames = []
+    for addr in sorted(by_addr):
+        reqs = by_addr[addr]
+        raw = reqs[-1].raw  # Latest request for a register wins
+        if frames:
+            start, values, members = frames[-1]
+            gap = range(start + len(values), addr)
+            if len(gap) <= MAX_WRITE_GAP and (addr - start) < MAX_WRITE_REGISTERS and \
+                    all(g in writable for g in gap):
+                values.extend([None] * len(gap))
+                values.append(raw)
+                members.extend(reqs)
+                continue
+        frames.append((addr, [raw], list(reqs)))
+    return frames
+
+WRITE_REJECTED = "ERR write rejected"  # The inverter answered the frame with an exception
+
+def split_frame(members):
+    """One single-register frame per address of a merged frame's requests."""
+    singles = {}
+    for req in members: singles.setdefault(req.field.addr, []).append(req)
+    return [(addr, [reqs[-1].raw], reqs) for addr, reqs in sorted(singles.items())]
+
+def fill_gaps(link, start, values):
+    """Current values for the None gaps of a planned frame, read just before it is sent so
+    a change made meanwhile (front panel, another client) is not reverted. None if the
+    read fails."""
+    raw = modbus_request(link, build_read_packet(start, len(values)), 3, len(values), name="gapfill")
+    if raw is None: return None
+    current = struct.unpack(f'>{len(values)}H', raw)
+    return [now if val is None else val for val, now in zip(values, current)]
+
+def write_frame(link, start, values):
+    """Sends one frame, checks the echo and reads the range back.
+    Returns (error, read-back values); the read-back is None if it never arrived."""
+    echo = modbus_request(link, build_write_packet(start, values), 16, name="write")
+    if echo is None:
+        if link.last_exception is not None: return f"{WRITE_REJECTED} (exception {link.last_exception})", None
+        return "ERR no response to write", None
+    if struct.unpack('>HH', echo) != (start, len(values)): return "ERR unexpected write echo", None
+    got = None
+    for attempt in range(READBACK_ATTEMPTS):
+        if attempt: time.sleep(0.2)  # Give the inverter a moment to commit the setting
+        raw = modbus_request(link, build_read_packet(start, len(values)), 3, len(values), name="readback")
+        if raw is None: continue
+        got = list(struct.unpack(f'>{len(values)}H', raw))
+        if got == values: break
+    if got is None: return "ERR write sent, read-back got no response", None
+    return None, got
+
+def run_pending_writes(inv, link):
+    """Flushes the write queue between poll cycles and publishes the read-back values.
+    Each request is judged by its own register, so one rejected value in a merged frame
+    does not fail the others. A merged frame the inverter rejects outright (e.g. because
+    a gap-filled register is read-only) is resent one register at a time."""
+    with inv.write_lock:
+        requests, inv.write_queue = inv.write_queue, []
+    if not requests: return
+    confirmed, replies = {}, []  # Replies go out once the snapshot shows the read-back (SYNC)
+    frames = plan_write_frames(requests, REGISTER_MAP.writable)
+    while frames:
+        start, values, members = frames.pop(0)
+        with inv.modbus_lock:
+            try:
+                filled = fill_gaps(link, start, values) if None in values else values
+                error, got = write_frame(link, start, filled) if filled else (None, None)
+            except Exception as e: filled, error, got = values, f"ERR {e}", None
+        if filled is None:
+            print(f"[!] {inv.serial}: could not read {start}+{len(values)} to fill gaps, splitting")
+            frames[0:0] = split_frame(members)
+            continue
+        if error and len(values) > 1 and error.startswith(WRITE_REJECTED):
+            print(f"[!] {inv.serial}: write {start}+{len(values)} rejected, splitting")
+            frames[0:0] = split_frame(members)
+            continue
+        if error:
+            print(f"[!] {inv.serial}: write {start}+{len(values)} failed: {error}")
+            replies.extend((req, error) for req in members)
+            continue
+        final = {req.field.addr: req.raw for req in members}
+        for req in members:
+            field = req.field
+            actual = got[field.addr - start]
+            confirmed[field.key] = field.decode_raw(actual)
+            if req.raw != final[field.addr]:
+                replies.append((req, "ERR superseded by a later write"))
+            elif actual != req.raw:
+                print(f"[!] {inv.serial}: {field.key} not applied (wrote {req.value}, reads {field.decode_raw(actual)})")
+                replies.append((req, f"ERR not applied: {field.key} reads {field.decode_raw(actual)}"))
+            else:
+                replies.append((req, "OK"))
+    with inv.data_lock:
+        for key, value in confirmed.items():
+            out = {key: value}
+            REGISTER_MAP.fields[key].expand(out)
+            inv.latest_data_json.update(out)
+        inv.publish_snapshot()
+    publish(inv)
+    for req, reply in replies: resolve(req.future, reply)
+
+def fail_pending_writes(inv, reply):
+    """Closes the queue until the next session and fails whatever is still in it."""
+    with inv.write_lock:
+        inv.writes_open = False
+        requests, inv.write_queue = inv.write_queue, []
+    for req in requests: resolve(req.future, reply)
+
+# --- REGISTER DISCOVERY ---
+class RegisterProfile:
+    """What --scan learned about one dongle: the register runs it answers and the largest
+    read it accepts. Registers outside the scanned range are left to the register map."""
+    def __init__(self, data):
+        self.data = data
+        self.max_read = data["max_read"]
+        self.scanned = tuple(data["scanned"])
+        self.runs = [tuple(r) for r in data["valid"]]  # Sorted [start, end) runs
+        self.starts = [r[0] for r in self.runs]
+
+    def probed(self, start, end):
+        return start < self.scanned[1] and end > self.scanned[0]
+
+    def covers(self, start, end):
+        """True if [start, end) is one answered run, or was never probed."""
+        if not self.probed(start, end): return True
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.runs[i][1] >= end
+
+    def rejects(self, start, end):
+        """True if the scan covered [start, end) entirely and no register of it answered."""
+        if not (self.scanned[0] <= start and end <= self.scanned[1]): return False
+        return not any(a < end and start < b for a, b in self.runs)
+
+def profile_path(serial):
+    return os.path.join(PROFILE_DIR, f"{serial}.json")
+
+def load_profile(serial):
+    """The cached scan of this serial, or None if it was never scanned."""
     try:
-        conn.settimeout(0.01)
-        while conn.recv(1024): pass
-    except: pass
-    finally: conn.settimeout(2.5)
+        with open(profile_path(serial)) as f: profile = RegisterProfile(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"[!] {serial}: ignoring unreadable register profile: {e}")
+        return None
+    if not profile.runs or not profile.max_read:
+        # Nothing answered during the scan (dongle asleep, wrong range): polling it would skip every block
+        print(f"[!] {serial}: ignoring register profile without answered registers, using the declared blocks")
+        return None
+    print(f"[*] {serial}: register profile loaded (largest read {profile.max_read}, {len(profile.runs)} runs)")
+    return profile
+
+def save_profile(data):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = profile_path(data["serial"])
+    with open(path + ".tmp", "w") as f: json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+    return path
+
+def merge_runs(reads):
+    """[(start, count)] -> sorted, merged [start, end) runs."""
+    runs = []
+    for start, count in sorted(reads):
+        if runs and start <= runs[-1][1]: runs[-1][1] = max(runs[-1][1], start + count)
+        else: runs.append([start, start + count])
+    return runs
+
+ILLEGAL_ADDRESS = 2  # Modbus exception code for registers that do not exist
+
+class RegisterScanner:
+    """Sweeps the holding registers of one dongle with function 3 reads. Up to SCAN_PIPELINE
+    reads go out back to back. Replies carry no address, so they are matched to the requests
+    in order; once a reply goes missing that order cannot be trusted, and the batch is
+    repeated one read at a time for the rest of the scan."""
+    def __init__(self, link):
+        self.link = link
+        self.depth = SCAN_PIPELINE
+        self.requests = 0
+        self.largest = 0  # Largest read answered so far
+        self.refused = set()  # (start, count) rejected for another reason than the address, e.g. too long
+
+    def exchange(self, batch):
+        """One result per (start, count): True if answered, False for an exception reply.
+        None if a reply was lost."""
+        link = self.link
+        link.discard_pending()
+        for start, count in batch: link.send(build_read_packet(start, count))
+        self.requests += len(batch)
+        results = []
+        for start, count in batch:
+            body = read_modbus_response(link, 3, count, SCAN_TIMEOUT)
+            result = "ok" if body is not None else "exception" if link.last_exception is not None else "timeout"
+            MODBUS_REQUESTS.inc((link.serial, "scan", result))
+            if result == "timeout": return None
+            if body is not None: self.largest = max(self.largest, count)
+            elif link.last_exception != ILLEGAL_ADDRESS: self.refused.add((start, count))
+            results.append(body is not None)
+        return results
+
+    def read_all(self, reads):
+        results, i, retries = [], 0, 0
+        while i < len(reads):
+            batch = reads[i:i + self.depth]
+            got = self.exchange(batch)
+            if got is None and self.depth > 1:
+                print("[!] Scan: a pipelined reply went missing, continuing one read at a time")
+                self.depth = 1
+                continue
+            if got is None and retries < SCAN_RETRIES:
+                retries += 1
+                continue
+            results += got if got is not None else [False]  # Never answered: treated as rejected
+            i, retries = i + len(batch), 0
+        return results
+
+    def sweep(self, first, last, size=MAX_READ_REGISTERS):
+        """Answered [start, end) runs in [first, last). A rejected read is split in halves.
+        Pieces bordering an answered run are split down to single registers, so run edges
+        are exact; elsewhere pieces of SCAN_RESOLUTION registers or less are skipped whole.
+        Only an illegal address reply marks registers as missing: a piece refused for another
+        reason (illegal data value for a read that is too long) is split down to single registers."""
+        reads = [(a, min(size, last - a)) for a in range(first, last, size)]
+        answered, edges = [], set()
+        while reads:
+            results = self.read_all(reads)
+            for (start, count), ok in zip(reads, results):
+                if ok:
+                    answered.append((start, count))
+                    edges.update((start, start + count))
+            print(f"[*] Scan: {len(reads)} reads of up to {max(c for _, c in reads)} registers, "
+                  f"{sum(results)} answered")
+            reads = [half for (start, count), ok in zip(reads, results)
+                     if not ok and (count > SCAN_RESOLUTION or (count > 1 and (
+                         start in edges or start + count in edges or (start, count) in self.refused)))
+                     for half in ((start, count // 2), (start + count // 2, count - count // 2))]
+        return merge_runs(answered)
+
+    def largest_read(self, runs):
+        """Binary search for the largest read the dongle answers, inside the longest run
+        (no read the poller makes can be longer than that)."""
+        if not runs: return 0
+        start, end = max(runs, key=lambda r: r[1] - r[0])
+        lo, hi = min(self.largest, end - start), min(SCAN_MAX_COUNT, end - start)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self.read_all([(start, mid)])[0]: lo = mid
+            else: hi = mid - 1
+        return lo
+
+def scan_registers(link, serial, first, last):
+    """Sweeps [first, last) and returns the profile to cache for this serial."""
+    started = time.monotonic()
+    scanner = RegisterScanner(link)
+    runs = scanner.sweep(first, last)
+    max_read = scanner.largest_read(runs)
+    return {"serial": serial, "scanned": [first, last], "max_read": max_read, "valid": runs,
+            "requests": scanner.requests, "seconds": round(time.monotonic() - started, 2),
+            "pipelined": scanner.depth > 1, "scanned_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+# --- POLL SCHEDULER ---
+class PollTask:
+    """One register group: its coalesced reads, target rate and achieved rate."""
+    def __init__(self, group, blocks, profile=None):
+        self.group = group
+        self.interval, self.priority = POLL_GROUPS.get(group, (5.0, 2))
+        max_registers = profile.max_read if profile else MAX_READ_REGISTERS
+        if profile: blocks = [piece for b in blocks for piece in split_block(b, max_registers)]
+        self.blocks = coalesce_blocks(blocks, max_registers, profile=profile)
+        self.next_due = 0.0
+        self.est_duration = 0.05  # EWMA of how long this group's reads take
+        self.avg_period = None    # EWMA of the time between successful samples
+        self.last_success = None
+
+    def run(self, link):
+        """Reads every block. Returns (values, all_ok, timed_out). A coalesced read the
+        dongle rejects with an exception reply is split back into its declared blocks."""
+        values, ok, timed_out = {}, True, False
+        i = 0
+        while i < len(self.blocks):
+            block = self.blocks[i]
+            decoded = modbus_read_block(link, block)
+            if decoded is None and link.last_exception is not None and len(block.parts) > 1:
+                print(f"[!] Read {block.name} rejected (exception {link.last_exception}), splitting")
+                self.blocks[i:i + 1] = block.parts
+                continue
+            if decoded is None:
+                ok = False
+                timed_out = timed_out or link.last_exception is None
+            else:
+                values.update(decoded)
+            i += 1
+        return values, ok, timed_out
 
-def read_modbus_response(conn):
+class PollScheduler:
+    """Runs the most important due group first, keeps realtime reads on schedule and
+    stretches all intervals while the dongle is timing out."""
+    def __init__(self, register_map, profile=None):
+        groups = {}
+        for block in register_map.blocks:
+            if profile and profile.rejects(block.start, block.start + block.count):
+                print(f"[!] Skipping block {block.name}: the register scan found none of {block.start}-"
+                      f"{block.start + block.count - 1} answered")
+                continue
+            groups.setdefault(block.group, []).append(block)
+        self.tasks = sorted((PollTask(g, blocks, profile) for g, blocks in groups.items()),
+                            key=lambda t: t.priority)
+        self.realtime = self.tasks[0] if self.tasks else None
+        self.backoff = 1.0
+
+    def next_task(self, now):
+        """The task to run now, or None if nothing is due (or it would make realtime late)."""
+        for task in self.tasks:
+            if task.next_due > now: continue
+            if task is self.realtime: return task
+            slack = (self.realtime.next_due - now) if self.realtime else float("inf")
+            # Low-priority reads wait for a gap, but are never starved for long
+            if task.est_duration <= slack or (now - task.next_due) > 2 * task.interval * self.backoff:
+                return task
+        return None
+
+    def sleep_time(self, now):
+        return max(0.0, min(t.next_due for t in self.tasks) - now) if self.tasks else POLL_INTERVAL
+
+    def complete(self, task, started, ok, timed_out):
+        now = time.monotonic()
+        task.est_duration = 0.8 * task.est_duration + 0.2 * (now - started)
+        if timed_out:
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        elif ok:
+            self.backoff = max(1.0, self.backoff * 0.8)
+            if task.last_success is not None:
+                period = now - task.last_success
+                task.avg_period = period if task.avg_period is None else 0.8 * task.avg_period + 0.2 * period
+            task.last_success = now
+        period = task.interval * self.backoff
+        # Fixed-rate schedule, but never try to catch up a backlog of missed samples
+        task.next_due += period
+        if task.next_due <= now: task.next_due = max(started + period, now)
+
+    def stats(self):
+        """Effective sample rate per group, reported in the JSON snapshot."""
+        return {t.group: {"target_hz": round(1.0 / t.interval, 3),
+                          "rate_hz": round(1.0 / t.avg_period, 3) if t.avg_period else 0.0,
+                          "reads": len(t.blocks)} for t in self.tasks}
+
+# --- BURST SAMPLING ---
+def burst_reads(register_map, keys=BURST_FIELDS):
+    """The fewest reads covering the burst fields this map knows, decoding nothing else."""
+    fields = [register_map.fields[k] for k in keys if k in register_map.fields]
+    return coalesce_blocks([RegisterBlock("burst", "burst", f.addr, f.width, [f]) for f in fields], name="burst")
+
+class Burst:
+    """One BURST capture: BURST_FIELDS at their true read times, kept as compact columns
+    until fetched with BURST_DATA."""
+    def __init__(self, seconds, interval, register_map):
+        self.seconds, self.interval = seconds, interval
+        self.blocks = burst_reads(register_map)
+        self.keys = [f.key for b in self.blocks for f in b.fields]
+        self.times = array.array('d')
+        self.columns = {k: array.array('f') for k in self.keys}
+        self.state = "queued"  # -> running -> done
+        self.started = self.finished = None
+        self.failures = 0
+
+    def add(self, t, values):
+        # Columns first: a reader that takes len(times) never sees a short column
+        for key, column in self.columns.items():
+            val = values.get(key)
+            column.append(math.nan if val is None else val)
+        self.times.append(t)
+
+    def to_json(self, serial):
+        n = len(self.times)
+        if n:
+            t0 = self.times[0]
+            cols = [[round((t - t0) * 1000, 1) for t in self.times[:n]]]
+            cols += [[None if v != v else round(v, 3) for v in self.columns[k][:n]] for k in self.keys]
+            rows = [list(r) for r in zip(*cols)]
+        span = self.times[n - 1] - self.times[0] if n > 1 else 0.0
+        return json.dumps({"inverter_id": serial, "state": self.state, "interval_ms": self.interval * 1000,
+                           "started": self.started, "samples": n, "failures": self.failures,
+                           "rate_hz": round((n - 1) / span, 2) if span else 0.0,
+                           "columns": ["t_ms"] + self.keys, "points": rows if n else []}).encode()
+
+def run_burst(inv, conn, link, burst, scheduler, last_sample, last_sample_time):
+    """Reads only the burst blocks, back to back or every `interval`, until the burst ends.
+    Each sample is integrated into the energy totals at its own read time, and the snapshot,
+    history and sample log still get one sample per POLL_INTERVAL. Queued writes and the
+    faults group's reads go out between burst reads.
+    Returns the last sample and its time for the poll loop's energy integration."""
+    burst.state, burst.started = "running", time.time()
+    print(f"[*] {inv.serial}: burst of {burst.seconds:g} s at {burst.interval * 1000:g} ms ({', '.join(burst.keys)})")
+    energy, last_publish = inv.energy, 0.0
+    faults = next((task for task in scheduler.tasks if task.group == "faults"), None)
+    next_due = time.monotonic()
+    deadline = next_due + burst.seconds
     try:
-        raw = conn.recv(1024)
-        if len(raw) < 5 or raw[1] & 0x80: return None
-        if modbus_crc(raw[:-2]) != raw[-2:]: return None
-        return [x[0] for x in struct.iter_unpack('>H', raw[3 : 3 + raw[2]])]
-    except: return None
+        while inv.conn is conn and len(burst.times) < BURST_MAX_SAMPLES:
+            if inv.write_queue: run_pending_writes(inv, link)
+            started = time.monotonic()
+            if faults and faults.next_due <= started:
+                # Fault edges are still caught at the faults group's own rate
+                with inv.modbus_lock:
+                    values, ok, timed_out = faults.run(link)
+                scheduler.complete(faults, started, ok, timed_out)
+                if values:
+                    events = inv.events.observe(time.time(), values, inv.latest_data_json)
+                    if events: publish_events(inv.serial, events)
+                    with inv.data_lock: inv.latest_data_json.update(values)
+            wait = next_due - time.monotonic()
+            if wait > 0: time.sleep(wait)
+            if time.monotonic() >= deadline: break
+            next_due = max(next_due + burst.interval, time.monotonic())
+
+            values = {}
+            with inv.modbus_lock:
+                for block in burst.blocks:
+                    decoded = modbus_read_block(link, block)
+                    if decoded is None: break
+                    values.update(decoded)
+                else: decoded = values
+            now = time.time()
+            if decoded is None:
+                burst.failures += 1
+                if link.silence() > STALE_LINK_SECONDS: break
+                continue
+
+            derive_realtime(values)
+            with energy_lock:
+                add_energy(inv.serial, energy, energy_increments(last_sample, last_sample_time, values, now))
+                inv.derived.add(now, values)
+                values.update(energy_json(energy))
+            last_sample, last_sample_time = values, now
+            burst.add(now, values)
+            maybe_save_energy(now)
+
+            if now - last_publish >= POLL_INTERVAL:
+                last_publish = now
+                with energy_lock: values.update(inv.derived.snapshot())
+                inv.history.append(now, values)
+                inv.log.append(now, values)
+                with inv.data_lock:
+                    inv.latest_data_json.update(values, link_state="online", stale=False, last_update=round(now, 3))
+                    inv.publish_snapshot()
+                publish(inv)
+    finally:
+        burst.state, burst.finished = "done", time.time()
+        print(f"[*] {inv.serial}: burst done, {len(burst.times)} samples, {burst.failures} failed reads")
+    return last_sample, last_sample_time
 
 # --- SERVERS ---
+def tune_dongle_socket(conn):
+    """Keepalive probes so a dongle that vanished (WiFi drop, power cut) is noticed in seconds
+    rather than the kernel's default two hours. Options this OS lacks are skipped."""
+    conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                        ("TCP_KEEPCNT", KEEPALIVE_COUNT),
+                        # Unacknowledged requests fail just as fast as an idle socket
+                        ("TCP_USER_TIMEOUT", 1000 * (KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT))):
+        if hasattr(socket, name):
+            conn.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+
+def set_link_state(inv, state):
+    """offline -> online <-> stale -> offline. Values are never wiped; `stale` tells consumers
+    they are the last ones read. Publishes only on a change."""
+    with inv.data_lock:
+        data = inv.latest_data_json
+        if data.get("link_state") == state: return
+        data["link_state"], data["stale"] = state, state != "online"
+        inv.publish_snapshot()
+    publish(inv)
+
 def inverter_server():
-    global current_inverter_conn, latest_data_json, last_cmd_time
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind((BIND_IP, INVERTER_PORT))
-    s.listen(1)
-
-    consecutive_failures = 0
-    loop_counter = 0
-    last_integration_time = time.time()
-    last_save_time = time.time()
+    s.listen(MAX_PENDING_DONGLES)
 
+    print("[*] Waiting for Inverter connections...")
     while True:
         try:
-            print("[*] Waiting for Inverter connection...")
             conn, addr = s.accept()
-            current_inverter_conn = conn
-            conn.settimeout(5.0) # Increased timeout for handshake
             print(f"[*] Inverter connected from {addr[0]}:{addr[1]}")
-            
-            # =========================================================
-            # === ACTIVE CLOUD EMULATION (Keep v78 Logic for Stability) ===
-            try:
-                # 1. Send the Cloud's "Who are you?" command immediately.
-                print("[*] Sending Wake-up Command (AT+DTUPN?)...")
-                conn.send(b'AT+DTUPN?\r\n')
+            tune_dongle_socket(conn)
+            # One thread per dongle: a slow handshake or hung unit never blocks the others
+            threading.Thread(target=handle_inverter, args=(conn, addr), daemon=True).start()
+        except Exception as e:
+            print(f"[!] Accept failed: {e}")
+            time.sleep(1)
+
+def dongle_handshake(conn, addr):
+    """Asks a freshly connected dongle who it is; returns its raw reply."""
+    conn.settimeout(5.0) # Increased timeout for handshake
+
+    # =========================================================
+    # === ACTIVE CLOUD EMULATION (Keep v78 Logic for Stability) ===
+    # 1. Send the Cloud's "Who are you?" command immediately.
+    print(f"[*] Sending Wake-up Command (AT+DTUPN?) to {addr[0]}...")
+    conn.send(b'AT+DTUPN?\r\n')
+
+    # 2. Wait for the Dongle to reply with its Serial Number
+    reply = conn.recv(1024)
+    print(f"[*] Dongle replied: {reply.decode(errors='ignore').strip()}")
+    # =========================================================
+    return reply
+
+def handle_inverter(conn, addr):
+    handshake_started = time.perf_counter()
+    try:
+        reply = dongle_handshake(conn, addr)
+    except Exception as e:
+        print(f"[!] Handshake failed ({addr[0]}): {e}")
+        HANDSHAKE_FAILURES.inc()
+        conn.close()
+        return
+
+    serial = parse_dongle_serial(reply, addr)
+    inv = get_or_create_inverter(serial)
+    # 3. Brief pause to let the dongle settle before Modbus. A dongle seen before tries without
+    #    it on reconnect, until one read right after skipping it has failed
+    skip_settle = not inv.needs_settle and (inv.fast_start or bool(inv.connected_at))
+    if not skip_settle: time.sleep(SETTLE_DELAY)
+    HANDSHAKE.observe((), time.perf_counter() - handshake_started)
+    CONNECTIONS.inc((serial,))
+    if inv.connected_at: RECONNECTS.inc((serial,))
+
+    # Take the dongle over before waiting for the Modbus lock: the old session stops at its
+    # next check of inv.conn, and the shutdown wakes a recv it may be blocked in right now.
+    old_conn, inv.conn = inv.conn, conn
+    if old_conn:
+        print(f"[*] {serial}: replacing previous connection")
+        try: old_conn.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+    with inv.modbus_lock:
+        inv.addr, inv.connected_at = addr, time.time()
+        inv.link = ModbusLink(conn, capture=inv.capture, serial=serial)
+        if inv.capture: inv.capture.session()
+    with inv.write_lock:
+        inv.writes_open = True
+
+    try:
+        poll_inverter(inv, conn, skip_settle)
+    except Exception as e:
+        POLL_ERRORS.inc((serial, type(e).__name__))
+        print(f"[!] {serial}: Connection lost ({type(e).__name__}: {e}), waiting for reconnect...")
+    finally:
+        conn.close()
+        with inv.modbus_lock:
+            dropped = inv.conn is conn
+            if dropped:
+                print(f"[!] {serial}: Inverter disconnected, keeping last values as stale")
+                inv.conn = inv.link = None
+                fail_pending_writes(inv, "ERR inverter disconnected")
+        if dropped: set_link_state(inv, "offline")
+
+def poll_inverter(inv, conn, skipped_settle=False):
+    """Polling loop for one dongle session; returns when the link is considered dead."""
+    consecutive_failures = 0
+    last_sample, last_sample_time = None, 0.0
+    energy = inv.energy
+    link = inv.link
+    scheduler = PollScheduler(REGISTER_MAP, inv.profile)
+    first_read = True
 
-                # 2. Wait for the Dongle to reply with its Serial Number
-                reply = conn.recv(1024)
-                print(f"[*] Dongle replied: {reply.decode(errors='ignore').strip()}")
-                
-                # 3. Brief pause to let the dongle settle before Modbus
-                time.sleep(0.5)
+    # === INNER POLLING LOOP ===
+    while inv.conn is conn:
+        # Writes go out between poll cycles, never in the middle of one
+        if inv.write_queue: run_pending_writes(inv, link)
+        burst = inv.burst
+        if burst and burst.state == "queued":
+            # Normal scheduling resumes afterwards without catching up the skipped reads
+            last_sample, last_sample_time = run_burst(inv, conn, link, burst, scheduler, last_sample, last_sample_time)
+            continue
 
+        started = time.monotonic()
+        task = scheduler.next_task(started)
+        if task is None:
+            inv.wakeup.wait(scheduler.sleep_time(started))
+            inv.wakeup.clear()
+            continue
+
+        with inv.modbus_lock:
+            try:
+                values, ok, timed_out = task.run(link)
+            except OSError as e:
+                # Closed, reset, or keepalive gave up: the socket is dead, retrying cannot help
+                POLL_ERRORS.inc((inv.serial, type(e).__name__))
+                if inv.conn is conn: print(f"[!] {inv.serial}: link lost ({e})")
+                return
             except Exception as e:
-                print(f"[!] Handshake failed: {e}")
-                conn.close()
-                continue
-            # =========================================================
+                POLL_ERRORS.inc((inv.serial, type(e).__name__))
+                values, ok, timed_out = {}, False, True
+        scheduler.complete(task, started, ok, timed_out)
+        latest_data_json = inv.latest_data_json
+        if values:
+            # Edges are caught at the faults group's poll rate, not just seen as the current state
+            events = inv.events.observe(time.time(), values, latest_data_json)
+            if events: publish_events(inv.serial, events)
 
-            conn.settimeout(2.5) # Revert to normal Modbus timeout
-            consecutive_failures = 0
-            
-            # === INNER POLLING LOOP ===
-            while True:
-                now = time.time()
-                time_delta = now - last_integration_time
-                last_integration_time = now
-
-                with modbus_lock:
-                    try:
-                        flush_buffer(conn) 
-                        conn.send(build_read_packet(200, 40))
-                        time.sleep(0.15) 
-                        vals = read_modbus_response(conn)
-
-                        if vals is None:
-                            consecutive_failures += 1
-                            if consecutive_failures >= OFFLINE_THRESHOLD: break
-                        else:
-                            consecutive_failures = 0
-                            
-                            # --- SENSOR DECODING ---
-                            v_batt = vals[15] / 10.0
-                            if v_batt < 10.0: v_batt = 48.0 # Protection from v89
-                            
-                            v_pv = vals[19] / 10.0
-                            p_pv = vals[23]
-                            p_pv_btt = vals[24] # New sensor from v89
-                            v_grid = vals[2] / 10.0
-                            p_grid = vals[4]
-                            p_load = vals[13]
-
-                            # --- CRITICAL FIX: TRUE BATTERY CURRENT (From v89) ---
-                            # Register 232 (Index 32) = Net Battery Current (Solar + Grid - Load)
-                            # Register map says: "Positive number means charging"
-                            raw_batt_current = to_signed(vals[32])
-                            batt_current = raw_batt_current / 10.0
-                            
-                            # Calculate True Battery Power (Watts)
-                            batt_p = int(batt_current * v_batt)
-
-                            # --- ENERGY INTEGRATION ---
-                            if time_delta > 0 and time_delta < 5.0:
-                                with energy_lock:
-                                    if p_pv > 0:
-                                        energy_data["total_pv_kwh"] += (p_pv * time_delta) / 3600000.0
-                                    if p_grid > 0:
-                                        energy_data["total_grid_input_kwh"] += (p_grid * time_delta) / 3600000.0
-                                    if p_load > 0:
-                                        energy_data["total_load_kwh"] += (p_load * time_delta) / 3600000.0
-                                    
-                                    # Battery Energy (Using corrected batt_p)
-                                    # Map says Positive = Charging
-                                    if batt_p > 0: 
-                                        energy_data["total_battery_charge_kwh"] += (batt_p * time_delta) / 3600000.0
-                                    elif batt_p < 0:
-                                        energy_data["total_battery_discharge_kwh"] += (abs(batt_p) * time_delta) / 3600000.0
-                                    
-                                    latest_data_json["total_pv_energy_kwh"] = round(energy_data["total_pv_kwh"], 4)
-                                    latest_data_json["total_grid_input_kwh"] = round(energy_data["total_grid_input_kwh"], 4)
-                                    latest_data_json["total_load_kwh"] = round(energy_data["total_load_kwh"], 4)
-                                    latest_data_json["total_battery_charge_kwh"] = round(energy_data["total_battery_charge_kwh"], 4)
-                                    latest_data_json["total_battery_discharge_kwh"] = round(energy_data["total_battery_discharge_kwh"], 4)
-
-                            # --- AUTO SAVE ---
-                            if (now - last_save_time) > SAVE_INTERVAL:
-                                save_energy_to_disk()
-                                last_save_time = now
-
-                            # --- JSON UPDATE ---
-                            latest_data_json.update({
-                                "device_status_code": vals[1],
-                                "device_status_msg": STATUS_MAP.get(vals[1], "Active"),
-                                "grid_volt": v_grid,
-                                "grid_freq": vals[3] / 100.0,
-                                "grid_power_watt": p_grid,
-                                "grid_current": round(p_grid / v_grid, 1) if v_grid > 0 else 0.0,
-                                "ac_out_volt": vals[5] / 10.0,
-                                "ac_out_amp": vals[11] / 10.0,
-                                "ac_output_amp": vals[11] / 10.0,
-                                "ac_load_real_watt": p_load,
-                                "ac_load_watt": p_load,
-                                "ac_load_va": vals[14],
-                                "ac_load_pct": round(min((vals[14]/INVERTER_RATED_WATT)*100, 300), 1),
-                                "batt_volt": v_batt, 
-                                "batt_soc": vals[29], 
-                                
-                                # UPDATED FIELDS
-                                "batt_power_watt": batt_p, 
-                                "batt_current": batt_current, 
-                                
-                                "pv_input_watt": p_pv, 
-                                "pv_charging_watt": p_pv_btt, # New
-                                "pv_input_volt": v_pv,
-                                "pv_current": round(p_pv / v_pv, 2) if v_pv > 0 else 0.0,
-                                "temp_dc": vals[27], 
-                                "temp_inv": vals[26], 
-                                "inverter_temp": vals[26]
-                            })
-                            
-                            # --- FAULT & WARNING READING (Updated logic from v89) ---
-                            if loop_counter % 2 == 0:
-                                # Read 12 registers instead of 6 to get warnings
-                                conn.send(build_read_packet(100, 12))
-                                time.sleep(0.1)
-                                vf = read_modbus_response(conn)
-                                if vf and len(vf) >= 10:
-                                    fault_val = (vf[0] << 16) | vf[1]
-                                    warn_val = (vf[8] << 16) | vf[9]
-                                    f_list = decode_flags(fault_val, FAULT_BIT_MAP, "Unknown F")
-                                    w_list = decode_flags(warn_val, WARNING_BIT_MAP, "Unknown W")
-                                    latest_data_json.update({
-                                        "fault_code": fault_val, 
-                                        "fault_msg": ", ".join(f_list) if f_list else "No Fault",
-                                        "fault_list": f_list, 
-                                        "warning_code": warn_val,
-                                        "warning_msg": ", ".join(w_list) if w_list else "No Warning",
-                                        "warning_list": w_list
-                                    })
-
-                            is_cooldown = (time.time() - last_cmd_time) < 10.0
-                            if (loop_counter % 5 == 0) and (not is_cooldown):
-                                conn.send(build_read_packet(301, 6))
-                                time.sleep(0.1)
-                                v300 = read_modbus_response(conn)
-                                if v300:
-                                    latest_data_json.update({
-                                        "output_mode": v300[0], "ac_input_range": v300[1],
-                                        "buzzer_mode": v300[2], "backlight_status": v300[4],
-                                        "return_to_default": v300[5]
-                                    })
-                                
-                                conn.send(build_read_packet(331, 3))
-                                time.sleep(0.1)
-                                v330 = read_modbus_response(conn)
-                                if v330:
-                                    latest_data_json.update({
-                                        "charger_priority": v330[0],
-                                        "max_total_amps": v330[1] / 10.0,
-                                        "max_ac_amps": v330[2] / 10.0
-                                    })
-                                
-                                conn.send(build_read_packet(341, 3))
-                                time.sleep(0.1)
-                                vsoc = read_modbus_response(conn)
-                                if vsoc:
-                                    latest_data_json.update({
-                                        "soc_back_to_grid": vsoc[0],
-                                        "soc_back_to_batt": vsoc[1],
-                                        "soc_cutoff": vsoc[2]
-                                    })
-                                
-                                # Updated v91: Read Registers 322-329 (Block Read 8)
-                                # 322: Battery Type
-                                # 324: Bulk Volt
-                                # 325: Float Volt
-                                # 329: Cut-off Volt
-                                conn.send(build_read_packet(322, 8))
-                                time.sleep(0.1)
-                                v322 = read_modbus_response(conn)
-                                if v322 and len(v322) >= 8:
-                                    latest_data_json.update({
-                                        "battery_type_code": v322[0],
-                                        "battery_type_msg": BATTERY_TYPE_MAP.get(v322[0], f"Unknown ({v322[0]})"),
-                                        "bulk_charge_volt": v322[2] / 10.0,
-                                        "float_charge_volt": v322[3] / 10.0,
-                                        "low_dc_cutoff_volt": v322[7] / 10.0
-                                    })
-
-                    except Exception:
-                        consecutive_failures += 1
-                        if consecutive_failures >= OFFLINE_THRESHOLD: break
-                loop_counter += 1
-                time.sleep(POLL_INTERVAL)
-        except: 
-            print("[!] Connection lost, waiting for reconnect...")
-            time.sleep(1)
+        if first_read:
+            # Only a read that skipped SETTLE_DELAY tells whether the dongle can do without it
+            first_read = False
+            if skipped_settle and ok: inv.fast_start = True
+            elif skipped_settle:
+                inv.fast_start, inv.needs_settle = False, True
+                print(f"[!] {inv.serial}: first read without settle delay failed, always settling from now on")
+        if not ok and link.silence() > STALE_LINK_SECONDS:
+            # Half-open link (dongle lost power or WiFi without a FIN): give up well before
+            # OFFLINE_THRESHOLD timeouts; the dongle's reconnect is taken over immediately anyway
+            print(f"[!] {inv.serial}: no reply for {link.silence():.1f} s, dropping the link")
+            break
+
+        if task is not scheduler.realtime:
+            # Settings blocks are independent: one failing must not hide the others.
+            # They are published together with the next realtime sample.
+            with inv.data_lock:
+                latest_data_json.update(values)
+            continue
+
+        now = time.time()
+
+        if not ok:
+            consecutive_failures += 1
+            FAILURE_STREAK.set((inv.serial,), consecutive_failures)
+            FAILURE_STREAK_MAX.set_max((inv.serial,), consecutive_failures)
+            if consecutive_failures == STALE_AFTER_FAILURES: set_link_state(inv, "stale")
+            if consecutive_failures >= OFFLINE_THRESHOLD: break
+            continue
+        if consecutive_failures: FAILURE_STREAK.set((inv.serial,), 0)
+        consecutive_failures = 0
+        
+        # --- SENSOR DECODING ---
+        derive_realtime(values)
+
+        # --- ENERGY INTEGRATION ---
+        # Trapezoids between successful samples; a few missed reads are bridged by
+        # interpolation, longer outages are left out rather than guessed.
+        with energy_lock:
+            add_energy(inv.serial, energy, energy_increments(last_sample, last_sample_time, values, now))
+            inv.derived.add(now, values)
+            values.update(energy_json(energy))
+            values.update(inv.derived.snapshot())
+        last_sample, last_sample_time = values, now
+
+        # --- AUTO SAVE ---
+        maybe_save_energy(now)
+        inv.history.append(now, values)
+        inv.log.append(now, values)
+
+        # --- JSON UPDATE ---
+        with inv.data_lock:
+            if latest_data_json["link_state"] == "offline":
+                print(f"[*] {inv.serial}: online, first sample {now - inv.connected_at:.2f} s after connect")
+            latest_data_json.update(values)
+            latest_data_json.update(link_state="online", stale=False, last_update=round(now, 3))
+            latest_data_json["poll_stats"] = scheduler.stats()
+            latest_data_json["poll_backoff"] = round(scheduler.backoff, 2)
+            inv.publish_snapshot()
+        publish(inv)
+
+# --- SUBSCRIPTIONS (push stream on the control port) ---
+subscribers = []  # Only touched on the control event loop
+control_loop = None
+
+def parse_deadbands(args):
+    """'batt_volt=0.2 ac_load_real_watt=25' -> {'batt_volt': 0.2, 'ac_load_real_watt': 25.0}"""
+    deadbands = {}
+    for arg in args:
+        key, _, band = arg.partition("=")
+        deadbands[key.lower()] = float(band)
+    return deadbands
+
+class Subscriber:
+    """One SUBSCRIBE connection. Poll threads only drop the newest snapshot into a mailbox;
+    the subscriber's coroutine diffs it against what it last sent and writes the delta,
+    so a slow consumer never delays polling and skipped snapshots are never queued up."""
+    def __init__(self, writer, target, deadbands):
+        self.writer = writer
+        self.target = target.upper() if target else None
+        self.deadbands = deadbands
+        self.sent = {}     # serial -> {key: value} as last sent to this client
+        self.pending = {}  # serial -> newest snapshot not yet diffed
+        self.resync = True
+        self.wake = asyncio.Event()
+        self.wake.set()
+
+    def wants(self, serial):
+        return self.target is None or self.target == serial.upper()
+
+    def offer(self, serial, snapshot):
+        self.pending[serial] = snapshot
+        self.wake.set()
+
+    def diff(self, serial, snapshot, full):
+        last = self.sent.setdefault(serial, {})
+        delta = {}
+        for key, val in snapshot.items():
+            if not full and key in last:
+                old = last[key]
+                if val == old: continue
+                band = self.deadbands.get(key)
+                if band and isinstance(val, (int, float)) and isinstance(old, (int, float)) \
+                        and abs(val - old) < band:
+                    continue  # Compared to the last *sent* value, so slow drift still gets through
+            delta[key] = val
+            last[key] = val
+        return delta
+
+    async def read_commands(self, reader):
+        """Only RESYNC is understood on an open stream. EOF just means no more commands:
+        the stream keeps going until a write fails."""
+        while True:
+            line = await reader.readline()
+            if not line: break
+            if line.strip().upper() == b"RESYNC":
+                self.resync = True
+                self.wake.set()
+
+    async def run(self, reader):
+        subscribers.append(self)
+        commands = asyncio.ensure_future(self.read_commands(reader))
+        try:
+            while not self.writer.is_closing():
+                await self.wake.wait()
+                self.wake.clear()
+                pending, self.pending = self.pending, {}
+                full, self.resync = self.resync, False
+                if full:
+                    with inverters_lock:
+                        for inv in inverters.values():
+                            if self.wants(inv.serial): pending.setdefault(inv.serial, inv.snapshot.data)
+                lines = []
+                for serial, snapshot in pending.items():
+                    delta = self.diff(serial, snapshot, full)
+                    if delta:
+                        delta["inverter_id"] = serial
+                        if full: delta["resync"] = True
+                        lines.append(json.dumps(delta))
+                if lines:
+                    self.writer.write(("\n".join(lines) + "\n").encode())
+                    await self.writer.drain()
+        except (ConnectionError, OSError): pass
         finally:
-            if current_inverter_conn:
-                print("[!] Inverter disconnected")
-                current_inverter_conn.close()
-                current_inverter_conn = None
-            latest_data_json = get_empty_data()
-
-def control_server():
-    global latest_data_json, last_cmd_time
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((BIND_IP, LOCAL_CONTROL_PORT))
-    s.listen(5)
-    while True:
+            subscribers.remove(self)
+            commands.cancel()
+
+def fan_out(serial, snapshot):
+    for sub in subscribers:
+        if sub.wants(serial): sub.offer(serial, snapshot)
+
+def publish(inv):
+    """Called by the poll loop once per cycle: hands the snapshot to every subscriber."""
+    if not subscribers or control_loop is None: return
+    control_loop.call_soon_threadsafe(fan_out, inv.serial, inv.snapshot.data)
+
+event_followers = []  # Only touched on the control event loop
+
+class EventFollower:
+    """One EVENTS_FOLLOW connection: the journaled events since a given time, then each new
+    raise or clear as it happens, one JSON object per line. Events are rare, so unlike
+    snapshots they are queued, never skipped; a client more than EVENT_JOURNAL_SIZE events
+    behind is disconnected instead."""
+    def __init__(self, writer, target):
+        self.writer = writer
+        self.target = target.upper() if target else None
+        self.pending = collections.deque()  # (serial, event) not yet written
+        self.sent = {}  # serial -> highest seq written, so catch-up and live events never overlap
+        self.wake = asyncio.Event()
+
+    def wants(self, serial):
+        return self.target is None or self.target == serial.upper()
+
+    def offer(self, serial, events):
+        self.pending.extend((serial, event) for event in events)
+        self.wake.set()
+
+    async def run(self, since):
+        event_followers.append(self)
         try:
-            client, _ = s.accept()
-            req = client.recv(1024).strip().decode().upper()
-            if req == "JSON":
-                client.send(json.dumps(latest_data_json).encode())
-            elif current_inverter_conn and req:
-                cmd_packet = None
-                if req.startswith("MODE_"): 
-                    cmd_packet = build_write_packet(301, int(req.split("_")[1]))
-                    latest_data_json["output_mode"] = int(req.split("_")[1])
-                elif req.startswith("SET_AC_RANGE_"):
-                    cmd_packet = build_write_packet(302, int(req.split("_")[3]))
-                    latest_data_json["ac_input_range"] = int(req.split("_")[3])
-                elif req == "CSO_SET":
-                    cmd_packet = build_write_packet(331, 1); latest_data_json["charger_priority"] = 1
-                elif req == "SNU_SET" or req == "CHARGE_ON":
-                    cmd_packet = build_write_packet(331, 2); latest_data_json["charger_priority"] = 2
-                elif req == "OSO_SET" or req == "CHARGE_OFF":
-                    cmd_packet = build_write_packet(331, 3); latest_data_json["charger_priority"] = 3
-                elif req.startswith("SET_AMPS_"): 
-                    val = int(req.split("_")[2])
-                    cmd_packet = build_write_packet(333, val * 10)
-                    latest_data_json["max_ac_amps"] = val
-                elif req.startswith("SET_TOTAL_AMPS_"): 
-                    val = int(req.split("_")[3])
-                    cmd_packet = build_write_packet(332, val * 10)
-                    latest_data_json["max_total_amps"] = val
-                elif req.startswith("SET_SOC_GRID_"):
-                    val = int(req.split("_")[3])
-                    cmd_packet = build_write_packet(341, val)
-                    latest_data_json["soc_back_to_grid"] = val
-                elif req.startswith("SET_SOC_BATT_"):
-                    val = int(req.split("_")[3])
-                    cmd_packet = build_write_packet(342, val)
-                    latest_data_json["soc_back_to_batt"] = val
-                elif req.startswith("SET_SOC_CUTOFF_"):
-                    val = int(req.split("_")[3])
-                    cmd_packet = build_write_packet(343, val)
-                    latest_data_json["soc_cutoff"] = val
-                elif req.startswith("SET_BUZZER_"):
-                    cmd_packet = build_write_packet(303, int(req.split("_")[2]))
-                    latest_data_json["buzzer_mode"] = int(req.split("_")[2])
-                elif req.startswith("SET_BACKLIGHT_"):
-                    cmd_packet = build_write_packet(305, int(req.split("_")[2]))
-                    latest_data_json["backlight_status"] = int(req.split("_")[2])
-                elif req.startswith("SET_RETURN_DEFAULT_"):
-                    cmd_packet = build_write_packet(306, int(req.split("_")[3]))
-                    latest_data_json["return_to_default"] = int(req.split("_")[3])
-                # NEW V78: Set Battery Type
-                elif req.startswith("SET_BATTERY_TYPE_"):
-                    val = int(req.split("_")[3])
-                    cmd_packet = build_write_packet(322, val)
-                    latest_data_json["battery_type_code"] = val
-                # NEW V91: Bulk/Float/Cut-off Voltages
-                elif req.startswith("SET_BULK_VOLT_"):
-                    val = float(req.split("_")[3])
-                    cmd_packet = build_write_packet(324, int(val * 10))
-                    latest_data_json["bulk_charge_volt"] = val
-                elif req.startswith("SET_FLOAT_VOLT_"):
-                    val = float(req.split("_")[3])
-                    cmd_packet = build_write_packet(325, int(val * 10))
-                    latest_data_json["float_charge_volt"] = val
-                elif req.startswith("SET_LOW_DC_CUTOFF_"):
-                    val = float(req.split("_")[4])
-                    cmd_packet = build_write_packet(329, int(val * 10))
-                    latest_data_json["low_dc_cutoff_volt"] = val
-                
-                if cmd_packet:
-                    with modbus_lock:
-                        flush_buffer(current_inverter_conn)
-                        current_inverter_conn.send(cmd_packet)
-                        last_cmd_time = time.time()
-                    client.send(b"OK")
-            client.close()
-        except: pass
+            if since is not None:
+                with inverters_lock:
+                    journals = [inv.events for inv in inverters.values() if self.wants(inv.serial)]
+                backlog = [(j.serial, e) for j in journals for e in j.query(since)]
+                self.pending.extend(sorted(backlog, key=lambda item: item[1]["t"]))
+                self.wake.set()
+            while not self.writer.is_closing():
+                await self.wake.wait()
+                self.wake.clear()
+                if len(self.pending) > EVENT_JOURNAL_SIZE:
+                    print("[!] Control: event follower too far behind, disconnecting")
+                    break
+                lines = []
+                while self.pending:
+                    serial, event = self.pending.popleft()
+                    if event["seq"] <= self.sent.get(serial, 0): continue
+                    self.sent[serial] = event["seq"]
+                    lines.append(json.dumps(dict(event, inverter_id=serial)))
+                if lines:
+                    self.writer.write(("\n".join(lines) + "\n").encode())
+                    await self.writer.drain()
+        except (ConnectionError, OSError): pass
+        finally:
+            event_followers.remove(self)
+
+def fan_out_events(serial, events):
+    for follower in event_followers:
+        if follower.wants(serial): follower.offer(serial, events)
+
+def publish_events(serial, events):
+    """Called by the poll loop with newly journaled events: hands them to every follower."""
+    if not event_followers or control_loop is None: return
+    control_loop.call_soon_threadsafe(fan_out_events, serial, events)
+
+# --- CONTROL PROTOCOL ---
+def split_target(req):
+    """'@<serial> CMD' addresses one inverter; a bare 'CMD' targets the only connected one."""
+    if req.startswith("@"):
+        target, _, req = req[1:].partition(" ")
+        return target, req.strip()
+    return None, req
+
+def inverter_list():
+    with inverters_lock:
+        return [{"inverter_id": inv.serial, "online": inv.conn is not None,
+                 "address": inv.addr[0] if inv.addr else None} for inv in inverters.values()]
+
+# Read handlers return bytes so cached snapshots go out without re-encoding
+def cmd_json(inv, arg): return inv.snapshot.encoded
+
+def cmd_json_if_newer(inv, arg):
+    """Empty reply when the client already holds the current generation."""
+    return b"" if arg.strip() == str(inv.snapshot.generation) else inv.snapshot.encoded
+
+def cmd_json_all(inv, arg):
+    with inverters_lock:
+        parts = [json.dumps(serial).encode() + b": " + i.snapshot.encoded for serial, i in inverters.items()]
+    return b"{" + b", ".join(parts) + b"}"
+
+def cmd_list(inv, arg): return json.dumps(inverter_list()).encode()
+
+def cmd_history(inv, arg):
+    """HISTORY <field> <seconds> [step]: min/avg/max per step-sized bucket, oldest first."""
+    parts = arg.lower().split()
+    if len(parts) not in (2, 3): return "ERR usage: HISTORY <field> <seconds> [step]"
+    key = parts[0]
+    if key not in inv.history.columns: return f"ERR no history for {key}"
+    seconds = min(float(parts[1]), HISTORY_SECONDS)
+    step = float(parts[2]) if len(parts) == 3 else POLL_INTERVAL
+    if seconds <= 0 or step <= 0: return "ERR seconds and step must be positive"
+    step = max(step, seconds / HISTORY_MAX_POINTS)
+    rows = inv.history.query(key, seconds, step)
+    return json.dumps({"inverter_id": inv.serial, "field": key, "step": step,
+                       "columns": ["t", "min", "avg", "max"], "points": rows}).encode()
+
+def cmd_range(inv, arg):
+    """RANGE <field> <start> <end> [step]: like HISTORY, but from the on-disk sample log."""
+    parts = arg.lower().split()
+    if len(parts) not in (3, 4): return "ERR usage: RANGE <field> <start> <end> [step]"
+    key = parts[0]
+    if key not in inv.log.fields: return f"ERR no sample log for {key}"
+    start, end = float(parts[1]), float(parts[2])
+    if end <= start: return "ERR end must be after start"
+    step = float(parts[3]) if len(parts) == 4 else POLL_INTERVAL
+    if step <= 0: return "ERR step must be positive"
+    step = max(step, (end - start) / HISTORY_MAX_POINTS)
+    tier, rows = inv.log.query(key, start, end, step)
+    return json.dumps({"inverter_id": inv.serial, "field": key, "step": step, "tier": tier,
+                       "columns": ["t", "min", "avg", "max"], "points": rows}).encode()
+
+def events_reply(inv, start=None, end=None):
+    return json.dumps({"inverter_id": inv.serial, "events": inv.events.query(start, end)}).encode()
+
+def cmd_events(inv, arg):
+    """EVENTS [start] [end]: journaled fault/warning raises and clears, oldest first."""
+    parts = arg.split()
+    if len(parts) > 2: return "ERR usage: EVENTS [start] [end]"
+    start = float(parts[0]) if parts else None
+    end = float(parts[1]) if len(parts) == 2 else None
+    return events_reply(inv, start, end)
+
+def cmd_burst(inv, arg):
+    """BURST <seconds> <interval_ms>: poll BURST_FIELDS only, as fast as asked (0 = as fast
+    as the dongle answers), then resume normal polling. Fetch the samples with BURST_DATA."""
+    parts = arg.split()
+    if len(parts) != 2: return "ERR usage: BURST <seconds> <interval_ms>"
+    seconds, interval_ms = float(parts[0]), float(parts[1])
+    if not 0 < seconds <= BURST_MAX_SECONDS: return f"ERR seconds must be in (0, {BURST_MAX_SECONDS}]"
+    if interval_ms < 0: return "ERR interval_ms must not be negative"
+    if inv.conn is None: return "ERR inverter offline"
+    if inv.burst and inv.burst.state != "done": return "ERR a burst is already running"
+    burst = Burst(seconds, interval_ms / 1000, REGISTER_MAP)
+    if not burst.blocks: return f"ERR no BURST_FIELDS in {REGISTER_MAP.name}"
+    inv.burst = burst
+    inv.wakeup.set()
+    return f"OK burst of {seconds:g} s at {interval_ms:g} ms queued"
+
+def cmd_burst_data(inv, arg):
+    """Samples of the latest burst (so far, while it runs) as one [t_ms, field...] array."""
+    if inv.burst is None: return "ERR no burst recorded"
+    return inv.burst.to_json(inv.serial)
+
+# Commands answered straight from memory on the event loop: (handler, needs an inverter)
+READ_COMMANDS = {
+    "JSON": (cmd_json, True),
+    "JSON_IF_NEWER": (cmd_json_if_newer, True),
+    "JSON_ALL": (cmd_json_all, False),
+    "LIST": (cmd_list, False),
+    "HISTORY": (cmd_history, True),
+    "RANGE": (cmd_range, True),
+    "BURST": (cmd_burst, True),
+    "BURST_DATA": (cmd_burst_data, True),
+    "EVENTS": (cmd_events, True),
+}
+
+# Fixed-value writes: command -> (JSON key, value)
+PRESET_COMMANDS = {
+    "CSO_SET": ("charger_priority", 1),
+    "SNU_SET": ("charger_priority", 2), "CHARGE_ON": ("charger_priority", 2),
+    "OSO_SET": ("charger_priority", 3), "CHARGE_OFF": ("charger_priority", 3),
+}
+
+# Parameterised writes: '<PREFIX><value>' -> (JSON key, value type)
+WRITE_COMMANDS = {
+    "MODE_": ("output_mode", int),
+    "SET_AC_RANGE_": ("ac_input_range", int),
+    "SET_AMPS_": ("max_ac_amps", int),
+    "SET_TOTAL_AMPS_": ("max_total_amps", int),
+    "SET_SOC_GRID_": ("soc_back_to_grid", int),
+    "SET_SOC_BATT_": ("soc_back_to_batt", int),
+    "SET_SOC_CUTOFF_": ("soc_cutoff", int),
+    "SET_BUZZER_": ("buzzer_mode", int),
+    "SET_BACKLIGHT_": ("backlight_status", int),
+    "SET_RETURN_DEFAULT_": ("return_to_default", int),
+    "SET_BATTERY_TYPE_": ("battery_type_code", int),   # NEW V78: Set Battery Type
+    "SET_BULK_VOLT_": ("bulk_charge_volt", float),     # NEW V91: Bulk/Float/Cut-off Voltages
+    "SET_FLOAT_VOLT_": ("float_charge_volt", float),
+    "SET_LOW_DC_CUTOFF_": ("low_dc_cutoff_volt", float),
+}
+
+def start_command(line):
+    """Answers a read at once; a write is queued and returned as a Future of its reply."""
+    target, req = split_target(line.strip().upper())
+    name, _, arg = req.partition(" ")
+    read = READ_COMMANDS.get(name)
+    if read:
+        handler, needs_inverter = read
+        inv = find_inverter(target) if needs_inverter else None
+        if needs_inverter and inv is None:
+            offline = offline_json() if not target and name in ("JSON", "JSON_IF_NEWER") else None
+            return offline or f"ERR no inverter matches '{target or '(none given)'}'"
+        return handler(inv, arg)
+
+    if name in PRESET_COMMANDS:
+        key, val = PRESET_COMMANDS[name]
+    else:
+        prefix, _, raw_val = name.rpartition("_")
+        write = WRITE_COMMANDS.get(prefix + "_")
+        if write is None: return f"ERR unknown command {name}"
+        key, val = write[0], write[1](raw_val)
+
+    inv = find_inverter(target)
+    if inv is None: return f"ERR no inverter matches '{target or '(none given)'}'"
+    return queue_write(inv, key, val)
+
+def command_label(line):
+    """Bounded metrics label: the command name, or the prefix of a parameterised write."""
+    _, req = split_target(line.strip().upper())
+    name = req.partition(" ")[0]
+    if name in READ_COMMANDS or name in PRESET_COMMANDS: return name
+    prefix = name.rpartition("_")[0] + "_"
+    return prefix if prefix in WRITE_COMMANDS else "unknown"
+
+def run_command(line):
+    """start_command, timed for the metrics; a write is timed until it is verified or fails."""
+    label, started = command_label(line), time.perf_counter()
+    reply = start_command(line)
+    if isinstance(reply, concurrent.futures.Future):
+        reply.add_done_callback(lambda f: COMMAND_LATENCY.observe((label,), time.perf_counter() - started))
+    else:
+        COMMAND_LATENCY.observe((label,), time.perf_counter() - started)
+    return reply
+
+async def finish_reply(reply):
+    if not isinstance(reply, concurrent.futures.Future): return reply
+    try: return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(reply)), WRITE_TIMEOUT)
+    except asyncio.TimeoutError: return "ERR write not confirmed in time"
+
+async def send_replies(writer, outbox):
+    for reply in outbox:
+        reply = await finish_reply(reply)
+        writer.write((reply.encode() if isinstance(reply, str) else reply) + b"\n")
+    await writer.drain()
+
+async def handle_control_client(reader, writer):
+    """Newline-separated commands, one reply line each. A plain 'echo CMD | nc' batch is
+    answered and closed; SESSION keeps the connection open for pipelined commands."""
+    persistent, buf = False, b""
+    try:
+        while True:
+            data = await reader.read(4096)
+            at_eof = not data
+            buf += data
+            if at_eof or (not persistent and not buf.endswith(b"\n")):
+                # Old clients may omit the newline: give the rest a moment, then take it as-is
+                if not at_eof:
+                    try: buf += await asyncio.wait_for(reader.readline(), 0.05)
+                    except asyncio.TimeoutError: pass
+                buf += b"\n"
+            *lines, buf = buf.split(b"\n")
+
+            # Writes of one batch are queued together so the poll thread can merge them into
+            # one frame; replies still go out in command order.
+            outbox, quit_requested = [], False
+            for line in (l.decode(errors="ignore") for l in lines):
+                if not line.strip(): continue
+                target, req = split_target(line.strip().upper())
+                if req.startswith("SUBSCRIBE"):
+                    # The connection stays open and is owned by the subscriber from here on
+                    try: deadbands = parse_deadbands(req.split()[1:])
+                    except ValueError:
+                        outbox.append(f"ERR bad value in {req}")
+                        continue
+                    await send_replies(writer, outbox)
+                    sub = Subscriber(writer, target, deadbands)
+                    print(f"[*] Control: subscriber added for {target or 'all inverters'}")
+                    await sub.run(reader)
+                    return
+                if req.partition(" ")[0] == "EVENTS_FOLLOW":
+                    # Like SUBSCRIBE, the connection now belongs to the event stream
+                    arg = req.partition(" ")[2].strip()
+                    try: since = float(arg) if arg else None
+                    except ValueError:
+                        outbox.append(f"ERR bad value in {req}")
+                        continue
+                    await send_replies(writer, outbox)
+                    print(f"[*] Control: event follower added for {target or 'all inverters'}")
+                    await EventFollower(writer, target).run(since)
+                    return
+                if req == "SESSION":
+                    persistent = True
+                    outbox.append("OK")
+                elif req == "SYNC":
+                    # Opt-in read-after-write: later commands of this connection run once
+                    # its queued writes are verified or have failed
+                    outbox = [await finish_reply(r) for r in outbox]
+                    outbox.append("OK")
+                elif req == "QUIT":
+                    quit_requested = True
+                    break
+                else:
+                    # Reads are answered at once from the published snapshot; the outbox
+                    # only keeps the replies in command order
+                    try: outbox.append(run_command(line))
+                    except ValueError: outbox.append(f"ERR bad value in {req}")
+            await send_replies(writer, outbox)
+            if at_eof or quit_requested or not persistent: break
+    except (ConnectionError, OSError): pass
+    finally:
+        writer.close()
+
+# --- HTTP (metrics and snapshot API) ---
+HTTP_STATUS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed"}
+JSON_TYPE = "application/json"
+
+async def read_http_request(reader):
+    """(method, path, query, headers) of the next request on a connection, None once the
+    client is gone or idle. Query values are lists; header names are lower case."""
+    line = await asyncio.wait_for(reader.readline(), HTTP_IDLE_TIMEOUT)
+    parts = line.decode("latin-1").split()
+    if len(parts) != 3: return None
+    headers = {}
+    while True:
+        header = await asyncio.wait_for(reader.readline(), 5.0)
+        if not header.strip(): break
+        name, _, value = header.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    if parts[2] == "HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+        headers.setdefault("connection", "close")
+    path, _, query = parts[1].partition("?")
+    return parts[0].upper(), path, urllib.parse.parse_qs(query), headers
+
+def etag_for(body):
+    # Weak: the same validator covers the plain and the gzip encoding
+    return f'W/"{zlib.crc32(body):08x}-{len(body):x}"'
+
+def not_modified(etag, headers):
+    tags = headers.get("if-none-match")
+    return tags is not None and (tags.strip() == "*" or etag in (t.strip() for t in tags.split(",")))
+
+async def handle_http_client(reader, writer, route):
+    """Minimal HTTP/1.1 server loop with keep-alive. `route(path, query)` returns
+    (status, body, content type, gzip-cached body or None). GET and HEAD only."""
+    try:
+        while True:
+            request = await read_http_request(reader)
+            if request is None: break
+            method, path, query, headers = request
+            if method not in ("GET", "HEAD"):
+                status, body, ctype, zipped = 405, b'{"error": "only GET and HEAD are supported"}', JSON_TYPE, None
+            else:
+                status, body, ctype, zipped = route(path, query)
+            etag = etag_for(body)
+            extra = [f"ETag: {etag}", "Cache-Control: no-cache", "Vary: Accept-Encoding"]
+            if status == 200 and not_modified(etag, headers):
+                status, body = 304, b""
+            elif len(body) >= GZIP_MIN_BYTES and "gzip" in headers.get("accept-encoding", ""):
+                body = zipped or gzip.compress(body, 6)
+                extra.append("Content-Encoding: gzip")
+            close = headers.get("connection", "").lower() == "close"
+            head = [f"HTTP/1.1 {status} {HTTP_STATUS[status]}", f"Content-Type: {ctype}",
+                    f"Content-Length: {len(body)}", *extra, f"Connection: {'close' if close else 'keep-alive'}"]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + (b"" if method == "HEAD" else body))
+            await writer.drain()
+            if close: break
+    except (asyncio.TimeoutError, ConnectionError, OSError, UnicodeDecodeError): pass
+    finally:
+        writer.close()
+
+def metrics_route(path, query):
+    if path == "/metrics": return 200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8", None
+    return 404, b"Not found: try /metrics\n", "text/plain", None
+
+def snapshot_body(inv, fields):
+    """The encoded snapshot, or a JSON object of only `fields` (missing keys are left out)."""
+    snapshot = inv.snapshot
+    if not fields: return snapshot.encoded
+    data = snapshot.data
+    return json.dumps({key: data[key] for key in fields if key in data}).encode()
+
+def query_list(query, name):
+    """?fields=a,b&fields=c -> ['a', 'b', 'c']"""
+    return [item.strip() for value in query.get(name, ()) for item in value.split(",") if item.strip()]
+
+def api_error(status, message):
+    return status, json.dumps({"error": message}).encode(), JSON_TYPE, None
+
+def api_route(path, query):
+    """/api/snapshot[/<serial>]?fields=...: one inverter, like JSON on the control port.
+    /api/snapshots?inverters=...&fields=...: {serial: snapshot} for several (default all).
+    /api/events[/<serial>]?start=...&end=...: the EVENTS reply."""
+    fields = query_list(query, "fields")
+    if path == "/api/snapshot" or path.startswith("/api/snapshot/"):
+        inv_id = path[len("/api/snapshot/"):] or None
+        inv = find_inverter(inv_id)
+        offline = offline_json() if inv is None and not inv_id else None
+        if offline: return 200, offline, JSON_TYPE, None
+        if inv is None: return api_error(404, f"no inverter matches '{inv_id or '(none given)'}'")
+        snapshot = inv.snapshot
+        if fields: return 200, snapshot_body(inv, fields), JSON_TYPE, None
+        if snapshot.gzipped is None and len(snapshot.encoded) >= GZIP_MIN_BYTES:
+            snapshot.gzipped = gzip.compress(snapshot.encoded, 6)  # Once per generation, shared by all clients
+        return 200, snapshot.encoded, JSON_TYPE, snapshot.gzipped
+    if path == "/api/snapshots":
+        wanted = {serial.upper() for serial in query_list(query, "inverters")}
+        with inverters_lock:
+            selected = [inv for serial, inv in inverters.items() if not wanted or serial.upper() in wanted]
+        parts = [json.dumps(inv.serial).encode() + b": " + snapshot_body(inv, fields) for inv in selected]
+        return 200, b"{" + b", ".join(parts) + b"}", JSON_TYPE, None
+    if path == "/api/inverters":
+        return 200, json.dumps(inverter_list()).encode(), JSON_TYPE, None
+    if path == "/api/events" or path.startswith("/api/events/"):
+        inv_id = path[len("/api/events/"):] or None
+        inv = find_inverter(inv_id)
+        if inv is None: return api_error(404, f"no inverter matches '{inv_id or '(none given)'}'")
+        try: bounds = [float(query[name][0]) if name in query else None for name in ("start", "end")]
+        except ValueError: return api_error(400, "start and end must be epoch seconds")
+        return 200, events_reply(inv, *bounds), JSON_TYPE, None
+    return api_error(404, "try /api/snapshot, /api/snapshots, /api/events or /api/inverters")
+
+async def control_server():
+    global control_loop
+    control_loop = asyncio.get_running_loop()
+    server = await asyncio.start_server(handle_control_client, BIND_IP, LOCAL_CONTROL_PORT, reuse_address=True)
+    if METRICS_PORT:
+        await asyncio.start_server(lambda r, w: handle_http_client(r, w, metrics_route),
+                                   BIND_IP, METRICS_PORT, reuse_address=True)
+        print(f"[*] Metrics on http://{BIND_IP}:{METRICS_PORT}/metrics")
+    if API_PORT:
+        await asyncio.start_server(lambda r, w: handle_http_client(r, w, api_route),
+                                   BIND_IP, API_PORT, reuse_address=True)
+        print(f"[*] Snapshot API on http://{BIND_IP}:{API_PORT}/api/snapshot")
+    async with server:
+        await server.serve_forever()
+
+def run_control_server():
+    asyncio.run(control_server())
 
 def handle_exit(signum, frame):
     print("[*] Stopping... Saving energy data.")
     save_energy_to_disk()
+    with inverters_lock:
+        logs = [inv.log for inv in inverters.values()]
+    for log in logs: log.flush(final=True)
+    with inverters_lock:
+        captures = [inv.capture for inv in inverters.values() if inv.capture]
+    for capture in captures: capture.flush()
     sys.exit(0)
 
-if __name__ == "__main__":
+def replay_main(path, samples_path=None):
+    samples_out = open(samples_path, 'w') if samples_path else None
+    try:
+        stats, totals = replay_capture(capture_files(path), samples_out)
+    finally:
+        if samples_out: samples_out.close()
+    speed = stats["span_s"] / stats["replay_s"] if stats["replay_s"] else 0
+    print(f"[*] Replayed {stats['span_s']:.0f} s of traffic in {stats['replay_s']:.2f} s ({speed:.0f}x)")
+    print(f"    Requests: {stats['requests']}, replies: {stats['replies']}, timeouts: {stats['timeouts']}, "
+          f"exceptions: {stats['exceptions']}, sessions: {stats['sessions']}, realtime samples: {stats['samples']}")
+    print(f"    PV: {totals['total_pv_kwh']:.4f} kWh")
+    print(f"    Grid Input: {totals['total_grid_input_kwh']:.4f} kWh")
+    print(f"    Load: {totals['total_load_kwh']:.4f} kWh")
+    print(f"    Battery Charge: {totals['total_battery_charge_kwh']:.4f} kWh")
+    print(f"    Battery Discharge: {totals['total_battery_discharge_kwh']:.4f} kWh")
+
+def scan_main(first, last):
+    """--scan: waits for one dongle, sweeps its registers and caches the profile by serial.
+    The bridge service must be stopped first, as the scan needs the inverter port."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try: s.bind((BIND_IP, INVERTER_PORT))
+    except OSError as e:
+        print(f"[!] Cannot listen on port {INVERTER_PORT} ({e}). Stop the bridge service before scanning.")
+        sys.exit(1)
+    s.listen(1)
+    print(f"[*] Scan: waiting for a dongle on port {INVERTER_PORT}...")
+    conn, addr = s.accept()
+    s.close()
+    with conn:
+        tune_dongle_socket(conn)
+        serial = parse_dongle_serial(dongle_handshake(conn, addr), addr)
+        time.sleep(SETTLE_DELAY)
+        print(f"[*] Scan: registers {first}-{last - 1} of {serial}")
+        profile = scan_registers(ModbusLink(conn, serial=serial), serial, first, last)
+    path = save_profile(profile)
+    print(f"[*] Scan finished in {profile['seconds']:.1f} s ({profile['requests']} reads"
+          f"{', pipelined' if profile['pipelined'] else ''}); largest read: {profile['max_read']} registers")
+    for start, end in profile["valid"]:
+        mapped = [f.key for f in REGISTER_MAP.fields.values() if start <= f.addr < end]
+        print(f"    {start}-{end - 1} ({end - start} registers, {len(mapped)} in {REGISTER_MAP.name.split(' (')[0]} map)")
+    print(f"[*] Profile saved to {path}; the bridge uses it from the next connect of {serial}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Local cloud bridge for Anenji / Easun / MPP Solar inverters")
+    parser.add_argument("--replay", metavar="CAPTURE",
+                        help="run a frame capture (with its rotated files) through the decoder and exit")
+    parser.add_argument("--samples", metavar="FILE", help="with --replay: write each decoded realtime sample as a JSON line")
+    parser.add_argument("--scan", metavar="FIRST-LAST", nargs="?", const=f"{SCAN_RANGE[0]}-{SCAN_RANGE[1] - 1}",
+                        help="probe the registers of the next dongle that connects, cache its profile and exit")
+    args = parser.parse_args()
+    if args.replay:
+        replay_main(args.replay, args.samples)
+        return
+    if args.scan:
+        first, _, last = args.scan.partition("-")
+        scan_main(int(first), int(last or first) + 1)
+        return
+
+    energy_data.update(load_or_create_energy_data())
     signal.signal(signal.SIGTERM, handle_exit)
     signal.signal(signal.SIGINT, handle_exit)
+    history_mb = int(HISTORY_SECONDS / POLL_INTERVAL) * (8 + 4 * len(HISTORY_FIELDS)) / 1e6
+    print(f"[*] History: {HISTORY_SECONDS / 3600:g} h of {len(HISTORY_FIELDS)} fields, "
+          f"{history_mb:.1f} MB per inverter ({'numpy' if np is not None else 'array'} queries)")
     
     t1 = threading.Thread(target=inverter_server, daemon=True)
-    t2 = threading.Thread(target=control_server, daemon=True)
-    t1.start(); t2.start()
+    t2 = threading.Thread(target=run_control_server, daemon=True)
+    t3 = threading.Thread(target=sample_log_writer, daemon=True)
+    t1.start(); t2.start(); t3.start()
     while True: time.sleep(1)
+
+if __name__ == "__main__":
+    main()
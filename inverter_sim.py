@@ -0,0 +1,293 @@
+"""Simulated Anenji/SRNE WiFi dongle for running inverter_bridge.py without hardware.
+
+Connects to the bridge like a hijacked dongle, answers AT+DTUPN?, serves the fault (100-111),
+realtime (200-239) and settings (300-343) registers with values that change like a real
+system, applies function 16 writes, and can inject latency, split frames, bad CRCs, lost
+replies, line noise and disconnects.
+
+    python3 inverter_sim.py --port 18899 --latency 40 --split 0.2 --corrupt 0.01
+"""
+import argparse
+import math
+import random
+import socket
+import struct
+import threading
+import time
+
+# --- REGISTER SPACE ---
+SERVED_RANGES = ((100, 111), (200, 239), (300, 343))  # Reads outside these get exception 02
+WRITABLE_RANGE = (300, 343)
+SETTINGS_DEFAULTS = {
+    301: 2, 302: 0, 303: 0, 305: 1, 306: 0,            # Output mode, AC range, buzzer, backlight, return
+    322: 6, 324: 564, 325: 540, 329: 480,              # Battery type, bulk/float/low cut-off (x10)
+    331: 3, 332: 1200, 333: 700,                       # Charger priority, total/AC amps (x10)
+    341: 10, 342: 60, 343: 3,                          # SOC back to grid / battery / cut-off
+}
+PV_PEAK_WATT = 4500
+BATTERY_WH = 5120  # 100 Ah at 51.2 V
+
+# --- MODBUS HELPERS ---
+CRC_TABLE = []
+for _byte in range(256):
+    _crc = _byte
+    for _ in range(8):
+        _crc = (_crc >> 1) ^ 0xA001 if _crc & 1 else _crc >> 1
+    CRC_TABLE.append(_crc)
+
+def modbus_crc(data):
+    crc = 0xFFFF
+    for b in data:
+        crc = (crc >> 8) ^ CRC_TABLE[(crc ^ b) & 0xFF]
+    return struct.pack('<H', crc)
+
+def exception_reply(slave, fc, code):
+    return bytes([slave, fc | 0x80, code])
+
+# --- SIMULATED INVERTER ---
+class SimulatedInverter:
+    """Register file plus a small energy-balance model: PV follows the sun (with passing
+    clouds), the load random-walks, the battery takes the difference and the grid takes
+    over below the SOC set in register 341 until SOC reaches register 342."""
+    def __init__(self, serial, seed=None, day_speed=1.0):
+        self.serial = serial
+        self.rng = random.Random(seed)
+        self.day_speed = day_speed  # >1 runs the solar day faster than the wall clock
+        self.regs = dict.fromkeys(range(100, 112), 0)
+        self.regs.update(dict.fromkeys(range(200, 240), 0))
+        self.regs.update(dict.fromkeys(range(300, 344), 0))
+        self.regs.update(SETTINGS_DEFAULTS)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_step = None
+        self.soc = 60.0
+        self.load = 800.0
+        self.clouds = 1.0
+        self.on_grid = False
+        self.fault_bits = 0
+        self.warning_bits = 0
+
+    def solar_hour(self, now):
+        t = time.localtime(self.started + (now - self.started) * self.day_speed)
+        return t.tm_hour + t.tm_min / 60 + t.tm_sec / 3600
+
+    def step(self, now):
+        """Advances the model to `now` and rewrites the realtime registers."""
+        dt = 0.0 if self.last_step is None else min(now - self.last_step, 10.0)
+        self.last_step = now
+        rng, regs = self.rng, self.regs
+        self.clouds = min(1.0, max(0.3, self.clouds + rng.gauss(0, 0.02)))
+        self.load = min(4500.0, max(150.0, self.load + rng.gauss(0, 40)))
+        hour = self.solar_hour(now)
+        pv = max(0.0, math.sin(math.pi * (hour - 6) / 12)) * PV_PEAK_WATT * self.clouds
+
+        if self.soc <= regs[341]: self.on_grid = True
+        elif self.soc >= regs[342]: self.on_grid = False
+        grid = self.load if self.on_grid else 0.0
+        net = pv - (0.0 if self.on_grid else self.load)  # Positive = charging
+        if self.soc >= 100.0 and net > 0:
+            pv, net = pv - net, 0.0  # Full battery: the MPPT backs off
+        self.soc = min(100.0, max(0.0, self.soc + net * dt * self.day_speed / 3600 / BATTERY_WH * 100))
+
+        batt_volt = 48.0 + self.soc * 0.06 + net / 4000 + rng.gauss(0, 0.05)
+        batt_current = net / batt_volt
+        grid_volt = 230.0 + rng.gauss(0, 1.5)
+        out_volt = 230.0 + rng.gauss(0, 0.3)
+        pv_volt = 320.0 + rng.gauss(0, 3) if pv > 0 else 15.0 + rng.gauss(0, 1)
+
+        regs[201] = 2 if self.on_grid else 3
+        regs[202] = int(grid_volt * 10)
+        regs[203] = int((50.0 + rng.gauss(0, 0.02)) * 100)
+        regs[204] = int(grid)
+        regs[205] = int(out_volt * 10)
+        regs[211] = int(self.load / out_volt * 10)
+        regs[213] = int(self.load)
+        regs[214] = int(self.load * 1.05)
+        regs[215] = int(batt_volt * 10)
+        regs[219] = max(0, int(pv_volt * 10))
+        regs[223] = int(pv)
+        regs[224] = int(max(0.0, net))
+        regs[226] = int(32 + self.load / 250 + rng.gauss(0, 0.3))
+        regs[227] = int(30 + abs(net) / 300 + rng.gauss(0, 0.3))
+        regs[229] = int(self.soc)
+        regs[232] = int(batt_current * 10) & 0xFFFF
+        regs[100], regs[101] = self.fault_bits >> 16, self.fault_bits & 0xFFFF
+        regs[108], regs[109] = self.warning_bits >> 16, self.warning_bits & 0xFFFF
+
+    def toggle_random_flag(self):
+        """Sets or clears one fault or warning bit, for exercising alarm handling."""
+        bit = 1 << self.rng.randrange(16)
+        if self.rng.random() < 0.3: self.fault_bits ^= bit
+        else: self.warning_bits ^= bit
+
+    def read(self, start, count):
+        """Big-endian register bytes, or None if the range is not served."""
+        end = start + count - 1
+        if count < 1 or not any(lo <= start and end <= hi for lo, hi in SERVED_RANGES): return None
+        with self.lock:
+            self.step(time.time())
+            return b''.join(struct.pack('>H', self.regs[a]) for a in range(start, end + 1))
+
+    def write(self, start, values):
+        lo, hi = WRITABLE_RANGE
+        if not values or start < lo or start + len(values) - 1 > hi: return False
+        with self.lock:
+            for i, val in enumerate(values): self.regs[start + i] = val
+        return True
+
+# --- DONGLE CONNECTION ---
+class Dongle:
+    """One TCP session towards the bridge, reconnecting forever until stop().
+    `on_event(kind, t, detail)` is called for 'connect', 'request' and 'response'."""
+    def __init__(self, sim, host, port, latency=0.0, jitter=0.0, split=0.0, corrupt=0.0,
+                 drop=0.0, garbage=0.0, disconnect_every=0.0, reconnect_delay=1.0,
+                 flag_rate=0.0, max_read=125, on_event=None):
+        self.sim, self.host, self.port = sim, host, port
+        self.latency, self.jitter = latency, jitter
+        self.split, self.corrupt, self.drop, self.garbage = split, corrupt, drop, garbage
+        self.disconnect_every, self.reconnect_delay = disconnect_every, reconnect_delay
+        self.flag_rate = flag_rate
+        self.max_read = max_read  # Larger reads get exception 03, like a dongle with a small buffer
+        self.on_event = on_event or (lambda kind, t, detail: None)
+        self.rng = random.Random(sim.rng.random())
+        self.sock = None
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.disconnect()
+
+    def disconnect(self):
+        """Drops the current session from any thread, like a dongle losing WiFi."""
+        sock = self.sock
+        if sock is None: return
+        try: sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
+
+    def run(self):
+        while self.running:
+            try:
+                self.sock = socket.create_connection((self.host, self.port), timeout=2)
+            except OSError:
+                time.sleep(0.2)
+                continue
+            self.sock.settimeout(None)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.on_event("connect", time.time(), None)
+            try:
+                self.serve(self.sock)
+            except OSError:
+                pass
+            finally:
+                self.sock.close()
+                self.sock = None
+            if self.running: time.sleep(self.reconnect_delay)
+
+    def serve(self, sock):
+        buf = b""
+        connected = time.time()
+        while self.running:
+            if self.disconnect_every and time.time() - connected >= self.disconnect_every:
+                print(f"[*] {self.sim.serial}: simulated disconnect")
+                return
+            sock.settimeout(0.5 if self.disconnect_every else None)
+            try: data = sock.recv(4096)
+            except socket.timeout: continue
+            if not data: return
+            buf += data
+            if buf.startswith(b"AT"):
+                if b"\n" not in buf and b"?" not in buf: continue
+                buf = b""
+                sock.sendall(f"+ok={self.sim.serial}\r\n".encode())
+                continue
+            buf = self.handle_frames(sock, buf)
+
+    def handle_frames(self, sock, buf):
+        """Answers every complete request in buf and returns the unconsumed rest."""
+        while len(buf) >= 8:
+            slave, fc = buf[0], buf[1]
+            if fc == 16:
+                if len(buf) < 7 or len(buf) < 9 + buf[6]: break
+                size = 9 + buf[6]
+            else:
+                size = 8
+            frame, buf = buf[:size], buf[size:]
+            if modbus_crc(frame[:-2]) != frame[-2:]: continue  # Real dongles stay silent
+            start, count = struct.unpack('>HH', frame[2:6])
+            self.on_event("request", time.time(), (fc, start, count))
+            if fc == 3 and count > self.max_read:
+                reply = exception_reply(slave, fc, 3)
+            elif fc == 3:
+                payload = self.sim.read(start, count)
+                reply = exception_reply(slave, fc, 2) if payload is None else \
+                    bytes([slave, 3, len(payload)]) + payload
+            elif fc == 16:
+                values = list(struct.unpack(f'>{count}H', frame[7:7 + 2 * count]))
+                reply = frame[:6] if self.sim.write(start, values) else exception_reply(slave, fc, 2)
+            else:
+                reply = exception_reply(slave, fc, 1)
+            reply += modbus_crc(reply)
+            if self.flag_rate and self.rng.random() < self.flag_rate: self.sim.toggle_random_flag()
+            self.send_reply(sock, reply)
+            self.on_event("response", time.time(), (fc, start, count))
+        return buf
+
+    def send_reply(self, sock, reply):
+        rng = self.rng
+        delay = self.latency + (rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay: time.sleep(delay)
+        if self.drop and rng.random() < self.drop: return
+        if self.corrupt and rng.random() < self.corrupt:
+            reply = reply[:-1] + bytes([reply[-1] ^ 0xFF])
+        if self.garbage and rng.random() < self.garbage:
+            reply = bytes(rng.randrange(256) for _ in range(rng.randint(1, 6))) + reply
+        if self.split and rng.random() < self.split:
+            cut = rng.randint(1, len(reply) - 1)
+            sock.sendall(reply[:cut])
+            time.sleep(0.005)
+            sock.sendall(reply[cut:])
+        else:
+            sock.sendall(reply)
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated inverter dongle(s) for inverter_bridge.py")
+    parser.add_argument("--host", default="127.0.0.1", help="bridge address")
+    parser.add_argument("--port", type=int, default=18899, help="bridge inverter port")
+    parser.add_argument("--serial", default="E5000SIM", help="serial prefix (a number is appended with --count)")
+    parser.add_argument("--count", type=int, default=1, help="number of dongles")
+    parser.add_argument("--latency", type=float, default=20, help="reply delay in ms")
+    parser.add_argument("--jitter", type=float, default=0, help="extra random delay up to this many ms")
+    parser.add_argument("--split", type=float, default=0, help="probability a reply arrives in two TCP segments")
+    parser.add_argument("--corrupt", type=float, default=0, help="probability of a bad CRC")
+    parser.add_argument("--drop", type=float, default=0, help="probability a reply is never sent")
+    parser.add_argument("--garbage", type=float, default=0, help="probability of noise bytes before a reply")
+    parser.add_argument("--disconnect-every", type=float, default=0, help="drop the session every N seconds")
+    parser.add_argument("--reconnect-delay", type=float, default=1.0, help="seconds before reconnecting")
+    parser.add_argument("--flag-rate", type=float, default=0, help="probability per reply of toggling an alarm bit")
+    parser.add_argument("--max-read", type=int, default=125, help="largest read answered (exception 03 above)")
+    parser.add_argument("--day-speed", type=float, default=1.0, help="solar day speed-up factor")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    dongles = []
+    for i in range(args.count):
+        serial = args.serial if args.count == 1 else f"{args.serial}{i + 1:02d}"
+        seed = None if args.seed is None else args.seed + i
+        sim = SimulatedInverter(serial, seed=seed, day_speed=args.day_speed)
+        dongles.append(Dongle(sim, args.host, args.port, latency=args.latency / 1000, jitter=args.jitter / 1000,
+                              split=args.split, corrupt=args.corrupt, drop=args.drop, garbage=args.garbage,
+                              disconnect_every=args.disconnect_every, reconnect_delay=args.reconnect_delay,
+                              flag_rate=args.flag_rate, max_read=args.max_read).start())
+        print(f"[*] Simulating {serial} -> {args.host}:{args.port}")
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        for dongle in dongles: dongle.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Regression checks for the energy write-ahead journal replayed at startup.
+
+    python3 -m unittest test_energy_journal
+"""
+import os
+import tempfile
+import unittest
+
+import inverter_bridge as bridge
+
+class EnergyJournalReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.journal = os.path.join(self.dir.name, "energy.wal")
+        self.saved = bridge.ENERGY_JOURNAL, bridge.journal_seq
+        bridge.ENERGY_JOURNAL, bridge.journal_seq = self.journal, 0
+        bridge.journal_pending.clear()
+
+    def tearDown(self):
+        bridge.ENERGY_JOURNAL, bridge.journal_seq = self.saved
+        bridge.journal_pending.clear()
+
+    def append(self, serial, **deltas):
+        with bridge.energy_lock:
+            bridge.add_energy(serial, dict(bridge.ENERGY_DEFAULTS), deltas)
+            records = bridge.pack_energy_journal()
+        with open(self.journal, "ab") as f: f.write(records)
+        return len(records)
+
+    def replay(self, seq=0):
+        data = {}
+        return bridge.replay_energy_journal(data, seq), data
+
+    def test_replays_records_newer_than_seq(self):
+        self.append("E1", total_pv_kwh=1.5)
+        self.append("E1", total_pv_kwh=0.25, total_load_kwh=2.0)
+        seq, data = self.replay(seq=1)
+        self.assertEqual(seq, 2)
+        self.assertEqual(data["E1"]["total_pv_kwh"], 0.25)
+        self.assertEqual(data["E1"]["total_load_kwh"], 2.0)
+
+    def test_long_serial_is_kept_whole(self):
+        serial = "E5000023123456789012345678901234"
+        self.append(serial, total_grid_input_kwh=3.0)
+        self.append(serial[:24], total_grid_input_kwh=1.0)
+        _, data = self.replay()
+        self.assertEqual(data[serial]["total_grid_input_kwh"], 3.0)
+        self.assertEqual(data[serial[:24]]["total_grid_input_kwh"], 1.0)
+
+    def test_torn_tail_is_cut_off(self):
+        good = self.append("E1", total_pv_kwh=1.0)
+        size = self.append("E1", total_pv_kwh=2.0)
+        with open(self.journal, "r+b") as f: f.truncate(good + size - 3)
+        seq, data = self.replay()
+        self.assertEqual((seq, data["E1"]["total_pv_kwh"]), (1, 1.0))
+        self.assertEqual(os.path.getsize(self.journal), good)
+        # Appends after the cut line up again
+        self.append("E1", total_pv_kwh=4.0)
+        self.assertEqual(self.replay()[1]["E1"]["total_pv_kwh"], 5.0)
+
+    def test_corrupt_record_stops_replay(self):
+        good = self.append("E1", total_load_kwh=1.0)
+        self.append("E1", total_load_kwh=2.0)
+        self.append("E1", total_load_kwh=4.0)
+        with open(self.journal, "r+b") as f:
+            f.seek(good + 20)
+            byte = f.read(1)
+            f.seek(good + 20)
+            f.write(bytes([byte[0] ^ 0xFF]))
+        seq, data = self.replay()
+        self.assertEqual((seq, data["E1"]["total_load_kwh"]), (1, 1.0))
+        self.assertEqual(os.path.getsize(self.journal), good)
+
+    def test_missing_journal(self):
+        self.assertEqual(self.replay(seq=7), (7, {}))
+
+if __name__ == "__main__":
+    unittest.main()
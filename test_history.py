@@ -0,0 +1,34 @@
+"""Regression checks for the in-memory History ring.
+
+    python3 -m unittest test_history
+"""
+import unittest
+
+import inverter_bridge as bridge
+
+class HistoryWindowTest(unittest.TestCase):
+    def filled(self, n, capacity=5):
+        history = bridge.History(fields=("batt_volt",), capacity=capacity)
+        for t in range(1, n + 1): history.append(float(t), {"batt_volt": 50.0 + t})
+        return history
+
+    def test_nothing_newer_than_since(self):
+        # A full, wrapped ring whose newest sample is older than the window
+        history = self.filled(7)
+        times, values = history.window("batt_volt", 7.0)
+        self.assertEqual((len(times), len(values)), (0, 0))
+        self.assertEqual(history.query("batt_volt", 10, 1, now=5000), [])
+
+    def test_partial_ring_nothing_newer(self):
+        history = self.filled(3)
+        self.assertEqual(len(history.window("batt_volt", 3.0)[0]), 0)
+
+    def test_window_across_wrap(self):
+        history = self.filled(7)
+        times, values = history.window("batt_volt", 4.0)
+        self.assertEqual(list(times), [5.0, 6.0, 7.0])
+        self.assertEqual(list(values), [55.0, 56.0, 57.0])
+        self.assertEqual(list(history.window("batt_volt", 0.0)[0]), [3.0, 4.0, 5.0, 6.0, 7.0])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Regression checks for the Modbus RTU frame assembler and the write-frame planner.
+
+    python3 -m unittest test_modbus_frames
+"""
+import unittest
+
+import inverter_bridge as bridge
+
+def rtu(*payload):
+    body = bytes(payload)
+    return body + bridge.modbus_crc(body)
+
+class ExtractFrameTest(unittest.TestCase):
+    def setUp(self):
+        self.link = bridge.ModbusLink(None)
+
+    def feed(self, data):
+        self.link.buf += data
+        return self.link.extract_frame(3, 2)
+
+    def test_reply_split_across_segments(self):
+        reply = rtu(1, 3, 4, 0x01, 0xF4, 0x00, 0x0A)
+        self.assertEqual(self.feed(reply[:4]), (None, None))
+        self.assertEqual(self.feed(reply[4:]), (3, bytes([4, 0x01, 0xF4, 0x00, 0x0A])))
+        self.assertEqual(len(self.link.buf), 0)
+
+    def test_garbage_and_bad_crc_are_skipped(self):
+        good = rtu(1, 3, 4, 0, 1, 0, 2)
+        corrupt = bytearray(good)
+        corrupt[4] ^= 0xFF
+        self.assertEqual(self.feed(b"\x00\xff" + bytes(corrupt) + good), (3, bytes([4, 0, 1, 0, 2])))
+        self.assertEqual(len(self.link.buf), 0)
+
+    def test_reply_of_another_length_is_skipped(self):
+        stale = rtu(1, 3, 2, 0, 9)  # Late reply to an earlier one-register read
+        self.assertEqual(self.feed(stale + rtu(1, 3, 4, 0, 1, 0, 2)), (3, bytes([4, 0, 1, 0, 2])))
+
+    def test_exception_reply(self):
+        self.assertEqual(self.feed(rtu(1, 0x83, 2)), (0x83, bytes([2])))
+
+    def test_write_echo_followed_by_next_frame(self):
+        self.link.buf += rtu(1, 16, 1, 0x55, 0, 2) + rtu(1, 3, 4, 0, 1, 0, 2)
+        self.assertEqual(self.link.extract_frame(16, 2), (16, bytes([1, 0x55, 0, 2])))
+        self.assertEqual(self.link.extract_frame(3, 2), (3, bytes([4, 0, 1, 0, 2])))
+
+class PlanWriteFramesTest(unittest.TestCase):
+    def request(self, key, value):
+        return bridge.WriteRequest(bridge.REGISTER_MAP.fields[key], value, None)
+
+    def plan(self, *requests):
+        return bridge.plan_write_frames(requests, bridge.REGISTER_MAP.writable)
+
+    def test_mapped_gap_is_left_to_fill(self):
+        grid, cutoff = self.request("soc_back_to_grid", 60), self.request("soc_cutoff", 15)
+        self.assertEqual(self.plan(cutoff, grid), [(341, [60, None, 15], [grid, cutoff])])
+
+    def test_unmapped_gap_starts_a_new_frame(self):
+        # 326-328 are not in the map, so they are never re-written
+        bulk = self.request("bulk_charge_volt", 56.0)
+        float_volt = self.request("float_charge_volt", 54.0)
+        low = self.request("low_dc_cutoff_volt", 44.0)
+        self.assertEqual(self.plan(low, float_volt, bulk), [(324, [560, 540], [bulk, float_volt]), (329, [440], [low])])
+
+    def test_latest_request_for_a_register_wins(self):
+        first, second = self.request("soc_cutoff", 20), self.request("soc_cutoff", 25)
+        self.assertEqual(self.plan(first, second), [(343, [25], [first, second])])
+
+    def test_split_frame(self):
+        grid, cutoff, again = self.request("soc_back_to_grid", 60), self.request("soc_cutoff", 15), \
+            self.request("soc_back_to_grid", 70)
+        [(_, _, members)] = self.plan(grid, cutoff, again)
+        self.assertEqual(bridge.split_frame(members), [(341, [70], [grid, again]), (343, [15], [cutoff])])
+
+if __name__ == "__main__":
+    unittest.main()